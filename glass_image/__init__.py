@@ -1 +1,7 @@
+"""Imaging and self-calibration of GLASS data. 
+
+Heavy dependencies (casatasks, casacore, spython and astropy) are imported by the
+functions that use them rather than at the top of the command line modules, so 
+that a CLI does not pay for importing them when only parsing arguments. 
+"""
 WSCLEANDOCKER='docker://alecthomson/wsclean:force_mask'
\ No newline at end of file
@@ -1,107 +1,345 @@
 """Steps and tasks for self-calibration
 """
-import shutil
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
 from pathlib import Path
-from time import sleep
+from typing import List, NamedTuple, Optional
 
-from casatasks import gaincal, applycal, mstransform, cvel, split
+import numpy as np
+from casatasks import gaincal, applycal, flagmanager
+from casatools import table
 
 from glass_image.logging import logger
 from glass_image.pointing import Pointing
-from glass_image.utils import remove_files_folders
+from glass_image.utils import get_available_cores, remove_files_folders, remove_files_folders_background, clone_ms
 from glass_image.options import CasaSCOptions
 
-def derive_apply_selfcal(in_point: Pointing, options: CasaSCOptions) -> Pointing:
+# Solution tables with a smaller fraction of unflagged solutions are not applied
+MIN_GOOD_SOLUTION_FRACTION = 0.01
+# Number of rows of calibrated visibilities copied into the output at a time
+APPLY_ROW_CHUNK = 10000
+
+
+class ChannelBlock(NamedTuple):
+    spw: int
+    start: int
+    end: int
+
+    @property
+    def selection(self) -> str:
+        """The CASA spw selection string of the block, e.g. `0:0~511`"""
+        return f"{self.spw}:{self.start}~{self.end}"
+
+
+def split_channel_blocks(spw_nchans: List[int], nspw: int) -> List[ChannelBlock]:
+    """Divide the channels of a set of spectral windows into `nspw` contiguous
+    blocks. Should there be multiple spectral windows, the blocks are divided
+    evenly among them, and a spectral window is used whole when there are at
+    least `nspw` of them. A block never spans spectral windows.
+
+    Args:
+        spw_nchans (List[int]): The number of channels in each spectral window
+        nspw (int): The number of channel blocks to form
+
+    Returns:
+        List[ChannelBlock]: The inclusive channel range of each block
+    """
+    if len(spw_nchans) >= nspw:
+        return [ChannelBlock(spw, 0, nchan - 1) for spw, nchan in enumerate(spw_nchans) if nchan > 0]
+
+    blocks_per_spw = int(np.ceil(nspw / len(spw_nchans)))
+
+    blocks = []
+    for spw, nchan in enumerate(spw_nchans):
+        edges = np.linspace(0, nchan, blocks_per_spw + 1, dtype=int)
+        logger.debug("Block edges of spectral window %d are %s", spw, edges)
+
+        blocks.extend(ChannelBlock(spw, int(a), int(b) - 1) for a, b in zip(edges[:-1], edges[1:]) if b > a)
+
+    return blocks
+
+
+def get_channel_blocks(ms: Path, nspw: int) -> List[ChannelBlock]:
+    """Divide the channels of a measurement set into `nspw` contiguous blocks.
+    These are used in place of physically regridding the measurement set into
+    `nspw` spectral windows.
+
+    Args:
+        ms (Path): Measurement set to inspect
+        nspw (int): The number of channel blocks to form
+
+    Returns:
+        List[ChannelBlock]: The inclusive channel range of each block
+    """
+    tb = table()
+    tb.open(f"{str(ms)}/SPECTRAL_WINDOW")
+    spw_nchans = [int(nchan) for nchan in tb.getcol("NUM_CHAN")]
+    tb.close()
+
+    logger.debug("%s has %d spectral windows with %s channels", ms, len(spw_nchans), spw_nchans)
+
+    return split_channel_blocks(spw_nchans, nspw)
+
+
+def get_flag_version_table(ms: Path, version: str) -> Path:
+    """The table `flagmanager` saves a flag version of a measurement set into. It
+    holds a FLAG column whose rows correspond to those of the measurement set.
+
+    Args:
+        ms (Path): The measurement set the flags were saved from
+        version (str): Name of the flag version
+
+    Returns:
+        Path: Path to the saved flag version
+    """
+    return Path(f"{str(ms)}.flagversions") / f"flags.{version}"
+
+
+def keep_calibrated_block(ms: Path, flag_version: str, block: ChannelBlock) -> None:
+    """Keep the result of calibrating the channels of a block. Their CORRECTED_DATA
+    is copied into DATA, and their FLAG into a saved flag version of the same
+    measurement set, so that the block's flags survive that version later being
+    restored. Other channels are left untouched.
+
+    Args:
+        ms (Path): Measurement set with a CORRECTED_DATA column
+        flag_version (str): Flag version of `ms` saved with `flagmanager`
+        block (ChannelBlock): The channels to keep
+    """
+    tb = table()
+    tb.open(f"{str(ms)}/DATA_DESCRIPTION")
+    ddids = [ddid for ddid, spw in enumerate(tb.getcol("SPECTRAL_WINDOW_ID")) if spw == block.spw]
+    tb.close()
+
+    ms_tb, flag_tb = table(), table()
+    ms_tb.open(str(ms), nomodify=False)
+    flag_tb.open(str(get_flag_version_table(ms, flag_version)), nomodify=False)
+    ms_sel = ms_tb.query(f"DATA_DESC_ID IN {ddids}")
+    flag_sel = flag_tb.selectrows(ms_sel.rownumbers())
+
+    nrows = ms_sel.nrows()
+    if nrows > 0:
+        npol = ms_sel.getcell("FLAG", 0).shape[0]
+        blc, trc = [0, block.start], [npol - 1, block.end]
+        for startrow in range(0, nrows, APPLY_ROW_CHUNK):
+            nrow = min(APPLY_ROW_CHUNK, nrows - startrow)
+            ms_sel.putcolslice(
+                "DATA", ms_sel.getcolslice("CORRECTED_DATA", blc, trc, [], startrow, nrow), blc, trc, [], startrow, nrow
+            )
+            flag_sel.putcolslice(
+                "FLAG", ms_sel.getcolslice("FLAG", blc, trc, [], startrow, nrow), blc, trc, [], startrow, nrow
+            )
+
+    flag_sel.close()
+    ms_sel.close()
+    flag_tb.close()
+    ms_tb.close()
+
+
+def get_good_solution_fraction(caltable: str) -> float:
+    """Compute the fraction of solutions in a calibration table that are not
+    completely flagged.
+
+    Args:
+        caltable (str): The calibration table to inspect
+
+    Returns:
+        float: Fraction of rows in the table with at least one unflagged solution
+    """
+    tb = table()
+    tb.open(caltable)
+    n_total = tb.nrows()
+    good_tb = tb.query("NOT ALL(FLAG)")
+    n_good = good_tb.nrows()
+    good_tb.close()
+    tb.close()
+
+    logger.debug("%s has %d of %d rows with valid solutions", caltable, n_good, n_total)
+
+    return n_good / max(n_total, 1)
+
+
+def remove_scratch_columns(ms: Path, columns: List[str]) -> None:
+    """Remove columns (e.g. MODEL_DATA, CORRECTED_DATA) from a measurement set
+    once they are no longer needed, reclaiming their storage. Columns that are
+    not present are ignored.
+
+    Args:
+        ms (Path): The measurement set to modify
+        columns (List[str]): Names of the columns to remove
+    """
+    tb = table()
+    tb.open(str(ms), nomodify=False)
+    to_remove = [column for column in columns if column in tb.colnames()]
+    if len(to_remove) > 0:
+        logger.info("Removing columns %s from %s", to_remove, ms)
+        tb.removecols(to_remove)
+    tb.close()
+
+
+def _solve_spw(
+    ms: str, caltable: str, spw: str, solint: str, calmode: str, minsnr: float
+) -> Optional[str]:
+    """Run `gaincal` against a single channel selection. This is intended
+    to be executed in a separate process.
+
+    Args:
+        ms (str): Measurement set to derive solutions for
+        caltable (str): Name of the solution table to create
+        spw (str): CASA spw selection string
+        solint (str): Solution interval
+        calmode (str): Calibration mode passed to `gaincal`
+        minsnr (float): Minimum signal-to-noise of acceptable solutions
+
+    Returns:
+        Optional[str]: The solution table, or None if it was not created
+    """
+    gaincal(
+        vis=ms,
+        caltable=caltable,
+        spw=spw,
+        solint=solint,
+        calmode=calmode,
+        minsnr=minsnr,
+    )
+
+    return caltable if Path(caltable).exists() else None
+
+
+def derive_apply_selfcal(in_point: Pointing, options: CasaSCOptions, cores: Optional[int] = None) -> Pointing:
     """Perform self-calibration using CASA. The input measurement set, represented by
-    `in_point` should have a MODEL_DATA column populated. The routine will transform
-    the measurement set into one with the expected number of spectral windows before
-    `gaincal` is performed. Solutions are applied, and the freshly created CORRECTED_DATA
-    is split into a new measurement set, with said column renamed as `DATA`.
-    
+    `in_point` should have a MODEL_DATA column populated. The channels of the
+    measurement set are divided into `options.nspw` blocks, and `gaincal` is performed
+    against each block using a channel selection.
+
+    The input measurement set is cloned and the solutions are applied to the clone.
+    `applycal` calibrates whole spectral windows, so each block's solutions are
+    applied to its spectral window in turn, and only the block's channels of the
+    resulting CORRECTED_DATA and FLAG are kept. The flags of the other channels
+    are restored after each application.
+
     This routine will create a new measurement set with a single `DATA` column. There
     is no current facility to append `CORRECTED_DATA` columns to the base measurement
-    set in this code base. 
+    set in this code base.
 
     Args:
         in_point (Pointing): Measurement set that has been populated with `MODEL_DATA`
         options (CasaSCOptions): Specification of the self-calibration routine to apply
+        cores (Optional[int], optional): Maximum number of processes used to solve channel blocks when `options.casa_parallel` is set. Defaults to None, which uses the available CPUs.
 
     Returns:
         Pointing: Self-calibrated measurement set
     """
-    logger.info(f"Will apply self-calibration to {in_point.ms}")
-
     caltable = f"pcal{options.round}"
-    logger.info(f"Will create solution table: {caltable}")
 
     outfield = f"{in_point.field}_{caltable}"
-    outms = str(in_point.ms.parent / f"{outfield}.{'.'.join(str(in_point.ms.name).split('.')[1:])}")
-    transform_ms_str = f"{outms}_transform"
+    outms = str(in_point.ms.parent / f"{outfield}.{in_point.ms_suffix}")
 
-    logger.info(f"Output measurement set: {outms}")
+    logger.info(
+        "Self-calibration round=%d solint=%s nspw=%d calmode=%s caltable=%s in=%s out=%s",
+        options.round,
+        options.solint,
+        options.nspw,
+        options.calmode,
+        caltable,
+        in_point.ms,
+        outms,
+    )
 
     # Creating return structure now. The output MS will be created either by:
     # - the original MS being copied in the case where the field was blank and no cleaning was performed, or
     # - self-calibration was performed
     out_point = Pointing(workdir=in_point.workdir, field=in_point.field, ms=Path(outms))
 
-    logger.info(f"MSTransforming to {transform_ms_str} with {options.nspw} SPWs")
-    mstransform(
-        vis=str(in_point.ms),
-        outputvis=transform_ms_str,
-        regridms=True,
-        nspw=options.nspw,
-        mode="channel",
-        nchan=-1,
-        start=0,
-        width=1,
-        chanbin=1,
-        createmms=False,
-        datacolumn="all",
-        combinespws=False,
-    )
+    spw_blocks = get_channel_blocks(in_point.ms, options.nspw)
 
-    logger.info(
-        f"Deriving gain solutions {caltable} with solint {options.solint} and calmode {options.calmode}"
-    )
-    gaincal(
-        vis=transform_ms_str,
-        caltable=caltable,
-        solint=options.solint,
-        calmode=options.calmode,
-        minsnr=options.minsnr,
-    )
+    logger.info("Deriving gain solutions %s over %d channel blocks", caltable, len(spw_blocks))
+    solve_args = [
+        (
+            str(in_point.ms),
+            f"{outfield}.{idx}",
+            spw_block.selection,
+            options.solint,
+            options.calmode,
+            options.minsnr,
+        )
+        for idx, spw_block in enumerate(spw_blocks)
+    ]
+    if options.casa_parallel and len(solve_args) > 1:
+        # Each channel block is solved independently. CASA is not fork-safe, so
+        # workers are spawned and import casatasks afresh.
+        max_workers = max(1, min(len(solve_args), cores or get_available_cores()))
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=get_context("spawn")) as executor:
+            futures = [executor.submit(_solve_spw, *args) for args in solve_args]
+            block_results = [future.result() for future in futures]
+    else:
+        block_results = [_solve_spw(*args) for args in solve_args]
+
+    block_caltables = []
+    flagged_caltables = []
+    for spw_block, block_caltable in zip(spw_blocks, block_results):
+        if block_caltable is None:
+            logger.warning("Solutions for %s were not created. ", spw_block.selection)
+            continue
+
+        # Applying a (nearly) entirely flagged table would still rewrite
+        # CORRECTED_DATA for no benefit
+        if get_good_solution_fraction(block_caltable) < MIN_GOOD_SOLUTION_FRACTION:
+            logger.warning(
+                "Solutions in %s for %s are mostly flagged. Not applying. ", block_caltable, spw_block.selection
+            )
+            flagged_caltables.append(Path(block_caltable))
+            continue
 
-    caltable_path = Path(caltable)
-    if not caltable_path.exists():
-        logger.warn(f"{caltable} was not created. Returning {in_point.ms}. Will copy the MS into for later rounds. ")
-        
-        shutil.copytree(
-            in_point.ms, out_point.ms
+        block_caltables.append((spw_block, block_caltable))
+
+    if len(flagged_caltables) > 0:
+        remove_files_folders_background(flagged_caltables)
+
+    if len(block_caltables) == 0:
+        logger.warning(
+            "No usable %s solutions were created. Returning %s. Will clone the MS for later rounds. ",
+            caltable,
+            in_point.ms,
         )
+
+        clone_ms(in_point.ms, out_point.ms)
         return out_point
-        
-    logger.info(f"Solutions derived. Applying to data. ")
 
-    # This will create a CORRECTED_DATA columns
-    applycal(vis=transform_ms_str, gaintable=caltable)
+    logger.info("Solutions derived. Applying to data. ")
 
-    logger.info(f"Spliting the CORRECTED_DATA column out")
-    in_ms_str = str(in_point.ms)
-    split_ms_str = f"{in_ms_str}_split"
+    # Blocks without usable solutions keep their original DATA in the clone
+    clone_ms(in_point.ms, out_point.ms)
 
-    split(vis=transform_ms_str, outputvis=split_ms_str, datacolumn="corrected")
+    flag_version = f"glass_{caltable}"
+    flag_versions = get_flag_version_table(out_point.ms, flag_version).parent
+    try:
+        flagmanager(vis=str(out_point.ms), mode="save", versionname=flag_version)
+        for spw_block, block_caltable in block_caltables:
+            # This will create a CORRECTED_DATA column, and flag the data whose
+            # solutions are flagged, across the whole spectral window
+            applycal(vis=str(out_point.ms), spw=str(spw_block.spw), gaintable=block_caltable, flagbackup=False)
+            keep_calibrated_block(out_point.ms, flag_version, spw_block)
+            flagmanager(vis=str(out_point.ms), mode="restore", versionname=flag_version)
+    except Exception:
+        # A partially calibrated clone must not be mistaken for a finished round
+        remove_files_folders([out_point.ms, flag_versions])
+        raise
 
-    logger.info("Transforming to a single spectral window")
+    remove_files_folders([flag_versions])
 
-    cvel(
-        vis=split_ms_str,
-        outputvis=outms,
-        mode="channel_b",
-    )
+    # Mirror the single DATA column of a split measurement set
+    remove_scratch_columns(out_point.ms, ["MODEL_DATA", "CORRECTED_DATA"])
+
+    logger.info("Solutions applied. Created %s", out_point.ms)
 
-    logger.info(f"Solutions applied. Created {out_point.ms}")
+    # Solutions are applied to the clone, so no CORRECTED_DATA is added to the
+    # input. The input of the first round is the measurement set provided by
+    # the user, and any MODEL_DATA it holds is kept. Later inputs were created
+    # by an earlier round, so their MODEL_DATA is only needed for this solve.
+    if options.drop_scratch_columns and options.round > 1:
+        remove_scratch_columns(in_point.ms, ["MODEL_DATA"])
 
-    remove_files_folders([Path(file) for file in (caltable, transform_ms_str, split_ms_str)])
+    remove_files_folders_background([Path(block_caltable) for _, block_caltable in block_caltables])
 
     return out_point
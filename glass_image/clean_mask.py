@@ -12,10 +12,9 @@ from typing import Optional
 
 from glass_image import WSCLEANDOCKER
 from glass_image.logging import logger
-from glass_image.pointing import Pointing
+from glass_image.pointing import Pointing, field_from_name
 from glass_image.configuration import get_round_options
-from glass_image.wsclean import pull_wsclean_container, generate_wsclean_header
-from glass_image.image_utils import cutout_mask
+from glass_image.utils import require_exists
 
 def create_clean_mask(
     ms_path: Path,
@@ -23,6 +22,9 @@ def create_clean_mask(
     mosaic_mask: Path,
     wsclean_img: Optional[Path] = None,
     workdir: Optional[Path] = None,
+    force: bool = False,
+    backend: str = "astropy",
+    run_wsclean: bool = False,
 ) -> None:
     """Extract a clean mask for a pointing from a larger masked image. Idea being to image
     the GLASS pointings individually, co-added to get optimal sensitivity, and then create
@@ -32,8 +34,9 @@ def create_clean_mask(
     Once this mask has been extracted then it may be supplied to wsclean. This might enable
     wsclean to clean a lot more aggressively with less worry of cleaning suprious sources. 
     
-    A dummy FITS header which contains the WSC to extract upon by creating a dirty 
-    image with wsclean with representative options. 
+    The FITS header which contains the WCS to extract upon is constructed from the
+    measurement set and imaging options. Alternatively it may be taken from a dirty
+    image created by wsclean with representative options. 
 
     Args:
         ms_path (Path): The measurement set that a clean mask will be extracted for
@@ -41,41 +44,51 @@ def create_clean_mask(
         mosaic_mask (Path): Path to the mask of the deep co-added image
         wsclean_img (Optional[Path], optional): Path to singularity image containing wsclean. Defaults to None.
         workdir (Optional[Path], optional): The directory where work will be carried out. Defaults to None.
+        force (bool, optional): Extract the clean mask even if an up-to-date one already exists. Defaults to False.
+        backend (str, optional): Reprojection backend, either `astropy` or `dfreproject`. Defaults to "astropy".
+        run_wsclean (bool, optional): Take the header from a dirty image made by wsclean, rather than constructing it. Defaults to False.
     """
-    assert ms_path.exists(), f"MS {ms_path} does not exist"
-    assert (
-        imager_config.exists()
-    ), f"Imager configuration {imager_config} does not exist"
+    from glass_image.wsclean import pull_wsclean_container, generate_wsclean_header, synthesize_wsclean_header
+    from glass_image.image_utils import cutout_mask, get_clean_mask_path, clean_mask_is_current
 
-    if workdir is None:
-        workdir = Path(ms_path.parent)
+    require_exists(ms_path, imager_config)
 
-    logger.info(f"Changing directory to: {workdir}")
-    os.chdir(workdir)
+    # The working directory is passed explicitly rather than changed to, so
+    # that this function may be safely called concurrently
+    workdir = Path(ms_path.parent if workdir is None else workdir).absolute()
+    logger.info(f"Working directory is: {workdir}")
 
     logger.debug(f"Input MS: {ms_path}")
-    name_comps = ms_path.name.split(".")
-    logger.debug(f"{name_comps}")
-    field = "_".join(name_comps[:1])
+    field = field_from_name(ms_path.name)
+    logger.debug(f"Field name: {field}")
 
-    point = Pointing(workdir=workdir, field=field, ms=Path(ms_path.name))
-
-    if wsclean_img is None:
-        logger.info("No wsclean-image provided. Will attempt to download. ")
-        wsclean_img = pull_wsclean_container()
-
-    logger.info(f"Formed point: {point}")
-    logger.info(f"WSClean image: {wsclean_img}")
+    point = Pointing(workdir=workdir, field=field, ms=workdir / ms_path.name)
 
     logger.debug(f"Getting Imager related options.")
 
     img_round_options = get_round_options(imager_config, img_round=0)
 
-    image_header = generate_wsclean_header(
-        wsclean_img=wsclean_img, point=point, options=img_round_options.wsclean
-    )
+    # Avoid constructing a header when there is nothing to do
+    clean_mask = get_clean_mask_path(point)
+    if not force and clean_mask_is_current(clean_mask, mosaic_mask, img_round_options.wsclean.size):
+        logger.info(f"Clean mask {clean_mask} is newer than {mosaic_mask}. Nothing to do. ")
+        return
+
+    logger.info(f"Formed point: {point}")
+
+    if run_wsclean:
+        if wsclean_img is None:
+            logger.info("No wsclean-image provided. Will attempt to download. ")
+            wsclean_img = pull_wsclean_container()
+        logger.info(f"WSClean image: {wsclean_img}")
+
+        image_header = generate_wsclean_header(
+            wsclean_img=wsclean_img, point=point, options=img_round_options.wsclean, workdir=workdir
+        )
+    else:
+        image_header = synthesize_wsclean_header(point=point, options=img_round_options.wsclean)
     
-    cutout_mask(image_header=image_header, mosaic_mask=mosaic_mask, point=point, options=img_round_options)
+    cutout_mask(image_header=image_header, mosaic_mask=mosaic_mask, point=point, options=img_round_options, force=force, backend=backend)
 
 
 def get_parser() -> ArgumentParser:
@@ -100,6 +113,22 @@ def get_parser() -> ArgumentParser:
     parser.add_argument(
         "-v", "--verbose", action="store_true", help="Enable verbose logging"
     )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Extract the clean mask even if an up-to-date one already exists",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["astropy", "dfreproject"],
+        default="astropy",
+        help="Reprojection backend used when the mosaic and image pixel grids are not aligned. astropy maps pixels with astropy.wcs, while dfreproject will use a GPU if available. ",
+    )
+    parser.add_argument(
+        "--run-wsclean",
+        action="store_true",
+        help="Take the image header from a dirty image made with wsclean, rather than constructing it from the measurement set",
+    )
     parser.add_argument(
         "--wsclean-image",
         type=Path,
@@ -120,7 +149,7 @@ def cli() -> None:
     if args.verbose:
         logger.setLevel(logging.DEBUG)
 
-    create_clean_mask(args.ms, args.imager_config.absolute(), args.mask, wsclean_img=args.wsclean_image)
+    create_clean_mask(args.ms, args.imager_config.absolute(), args.mask, wsclean_img=args.wsclean_image, force=args.force, backend=args.backend, run_wsclean=args.run_wsclean)
 
 
 if __name__ == "__main__":
@@ -2,9 +2,16 @@
 configuration based imaging specification
 """
 
+from copy import deepcopy
 from pathlib import Path
 import yaml 
-from typing import Any, Dict
+from functools import lru_cache
+from typing import Any, Dict, List
+
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
 
 from glass_image.logging import logger 
 from glass_image.errors import ImagerConfigurationError
@@ -13,24 +20,43 @@ from glass_image.options import WSCleanOptions, CasaSCOptions, ImageRoundOptions
 OPTIONTYPES = ('casasc', 'wsclean')
 
 
-def load_yaml_configuration(yaml_config: Path) -> Dict[Any, Any]:
-    """Load in a image configuration file that directs imaging and self-calibration
+@lru_cache(maxsize=32)
+def _parse_yaml_configuration(yaml_config: str, mtime_ns: int) -> Dict[Any, Any]:
+    """Parse a YAML configuration file. The modification time is part of the
+    cache key so that a changed file is parsed again. 
 
     Args:
-        yaml_config (Path): Path to a YAML configuration file
+        yaml_config (str): Resolved path to a YAML configuration file
+        mtime_ns (int): Modification time of the file, in nanoseconds
 
     Returns:
-        Dict[Any, Any]: Loaded imager parame
+        Dict[Any, Any]: Loaded imager parameters
     """
-    logger.info(f"Loading configuration file {str(yaml_config)}")
+    logger.info(f"Loading configuration file {yaml_config}")
     with open(yaml_config, 'r') as in_config:
         config = yaml.load(
             in_config,
-            yaml.Loader
+            _Loader
         )
         
     return config 
 
+
+def load_yaml_configuration(yaml_config: Path) -> Dict[Any, Any]:
+    """Load in a image configuration file that directs imaging and self-calibration. 
+    Parsed files are cached, and a copy is returned so callers may freely modify it. 
+
+    Args:
+        yaml_config (Path): Path to a YAML configuration file
+
+    Returns:
+        Dict[Any, Any]: Loaded imager parame
+    """
+    yaml_config = Path(yaml_config).resolve()
+    config = _parse_yaml_configuration(str(yaml_config), yaml_config.stat().st_mtime_ns)
+
+    return deepcopy(config)
+
 def verify_configuration(yaml_config: Path):
     """Perorms basic sanity checks against an imager configuration file
 
@@ -72,18 +98,14 @@ def get_imager_options(yaml_config: Path) -> Dict[Any, Any]:
 
     return config['glass']
 
-def get_round_options(yaml_config: Path, img_round: int) -> ImageRoundOptions:
-    """Returns options specific to a single imaging / self-calibration round. If
-    the is the first image round, generic self-calibration options are return. In
-    the imager configuration, round 0 corresponds to the initial image _outside_
-    the self-calibration->image loop. 
-    
-    Rounds >= 1 are where both self-calibration and wsclean options are returned
-    with informative (specified) parameters. 
+def _build_round_options(config: Dict[Any, Any], img_round: int, yaml_config: Path) -> ImageRoundOptions:
+    """Construct the options for a single imaging / self-calibration round from
+    a loaded imager configuration. See `get_round_options`. 
 
     Args:
-        yaml_config (Path): Path to the imager configuration file
+        config (Dict[Any, Any]): The loaded imager configuration
         img_round (int): Imager round. 0 implies first image with no self-calibration. 
+        yaml_config (Path): Path to the imager configuration file, used when reporting errors
 
     Raises:
         ImagerConfigurationError: Raised when configuration file not correctly formed. 
@@ -91,9 +113,6 @@ def get_round_options(yaml_config: Path, img_round: int) -> ImageRoundOptions:
     Returns:
         ImageRoundOptions: Imaging and self-calibration options
     """
-    
-    config = load_yaml_configuration(yaml_config)
-    
     if img_round == 0:
         return ImageRoundOptions(
             wsclean = WSCleanOptions(round=0, **config['default']['wsclean']), 
@@ -101,19 +120,20 @@ def get_round_options(yaml_config: Path, img_round: int) -> ImageRoundOptions:
         )
     
     logger.debug("Loading the defaults")
-    casa_config_args = config['default']['casasc']
-    wsclean_config_args = config['default']['wsclean']
+    # Copies, as the defaults are shared between rounds
+    casa_config_args = dict(config['default']['casasc'])
+    wsclean_config_args = dict(config['default']['wsclean'])
     
     sc_configs = config['sc']
     if img_round in sc_configs.keys():
-        logger.info(f"Image round {img_round} in configuration file")
+        logger.info("Image round %d in configuration file", img_round)
         round_config = sc_configs[img_round]
-        logger.debug(f"SC round config: {round_config}")
+        logger.debug("SC round config: %s", round_config)
     
         valid = False
         for (key, args) in zip(['casasc', 'wsclean'], [casa_config_args, wsclean_config_args]):
             if key in round_config.keys():
-                logger.debug(f"Found {key} in config for {img_round=}. Updating defaults. ")
+                logger.debug("Found %s in config for img_round=%d. Updating defaults. ", key, img_round)
                 args.update(round_config[key])
                 valid = True
     
@@ -124,6 +144,46 @@ def get_round_options(yaml_config: Path, img_round: int) -> ImageRoundOptions:
         wsclean=WSCleanOptions(round=img_round, **wsclean_config_args), 
         casasc=CasaSCOptions(round=img_round, **casa_config_args)         
     )
-        
-        
+
+
+def get_round_options(yaml_config: Path, img_round: int) -> ImageRoundOptions:
+    """Returns options specific to a single imaging / self-calibration round. If
+    the is the first image round, generic self-calibration options are return. In
+    the imager configuration, round 0 corresponds to the initial image _outside_
+    the self-calibration->image loop. 
     
+    Rounds >= 1 are where both self-calibration and wsclean options are returned
+    with informative (specified) parameters. 
+
+    Args:
+        yaml_config (Path): Path to the imager configuration file
+        img_round (int): Imager round. 0 implies first image with no self-calibration. 
+
+    Raises:
+        ImagerConfigurationError: Raised when configuration file not correctly formed. 
+
+    Returns:
+        ImageRoundOptions: Imaging and self-calibration options
+    """
+    config = load_yaml_configuration(yaml_config)
+
+    return _build_round_options(config, img_round, yaml_config)
+
+
+def get_all_round_options(yaml_config: Path, n_rounds: int) -> List[ImageRoundOptions]:
+    """Returns the options for rounds 0 to `n_rounds - 1`, loading the imager
+    configuration file once. See `get_round_options`. 
+
+    Args:
+        yaml_config (Path): Path to the imager configuration file
+        n_rounds (int): Number of rounds, including the initial round 0, to return options for
+
+    Raises:
+        ImagerConfigurationError: Raised when configuration file not correctly formed. 
+
+    Returns:
+        List[ImageRoundOptions]: Imaging and self-calibration options, indexed by round
+    """
+    config = load_yaml_configuration(yaml_config)
+
+    return [_build_round_options(config, img_round, yaml_config) for img_round in range(n_rounds)]
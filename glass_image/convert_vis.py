@@ -1,18 +1,20 @@
 """Utilities to convert the miriad visibility data into a measurement set
 """
+import os
+import sys
 import shutil
-import numpy as np
+import tempfile
 import logging
 from pathlib import Path
 from argparse import ArgumentParser
-from typing import Optional
-from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+from functools import partial
+from typing import Callable, Iterable, Optional, List, Tuple
 
-from casatasks import importmiriad
-from pyrap import tables
-
-from glass_image.logging import logger
-from glass_image.utils import remove_files_folders, ensure_dir_exists, call
+from glass_image.logging import logger, set_worker_log_level
+from glass_image.pointing import field_from_name
+from glass_image.utils import remove_files_folders, ensure_dir_exists, call, stage_timer
 
 def remove_nonconformant_timesteps(target_ms: Path, baselines: int=15) -> None:
     """Some ATCA measurement sets has a strange number of TIMESTEPS recorded, which
@@ -25,22 +27,30 @@ def remove_nonconformant_timesteps(target_ms: Path, baselines: int=15) -> None:
         target_ms (Path): The measurement set to scan and correct. 
         baselines (int, optional): The required number of baselines to be present. Defaults to 15.
     """
+    from pyrap import tables
+
     logger.info(f"Searching for non-conformant time steps in {target_ms}")
 
     logger.info(f"Will ensure {baselines} aselines in each step")
     logger.debug(f"Opening {target_ms}")
     tab = tables.table(str(target_ms))
     
-    counts = Counter(tab.getcol('TIME'))
-    mask = [counts[i] == 15 for i in tab.getcol('TIME')]
+    # Let casacore group rows by timestep, rather than pulling the full TIME
+    # column into python. Only the (small) per-timestep summary is returned. 
+    counts_tab = tables.taql("SELECT TIME, gcount() AS N FROM $tab GROUPBY TIME")
+    step_times = counts_tab.getcol('TIME')
+    step_rows = counts_tab.getcol('N')
+    counts_tab.close()
     
-    total_timesteps = len(mask)
-    valid_timesteps = np.sum(mask)
+    valid_times = step_times[step_rows == baselines]
+    total_timesteps = tab.nrows()
+    valid_timesteps = int(step_rows[step_rows == baselines].sum())
     
     logger.info(f"{valid_timesteps} of {total_timesteps} had {baselines} baselines. ")
     
     if valid_timesteps == total_timesteps:
         logger.info("All timesteps are valid. Returning without producing corrected MS. ")
+        tab.close()
         
         return
     
@@ -49,11 +59,11 @@ def remove_nonconformant_timesteps(target_ms: Path, baselines: int=15) -> None:
     nonconform_ms = target_ms.with_suffix(target_ms.suffix + '_nonconform')    
     temp_ms = target_ms.with_suffix(target_ms.suffix + '_temp')    
     
-    idx = np.arange(np.array(mask).shape[0])[mask]
-    sub_tab = tab.selectrows(idx) 
+    sub_tab = tables.taql("SELECT FROM $tab WHERE TIME IN $valid_times")
     
     logger.info(f"Writing out {temp_ms}")
     sub_tab.copy(str(temp_ms), deep=True)
+    sub_tab.close()
 
     tab.close()
 
@@ -64,6 +74,40 @@ def remove_nonconformant_timesteps(target_ms: Path, baselines: int=15) -> None:
     temp_ms.rename(target_ms)
 
     
+def get_scratch_dir(miriad_vis: Path, headroom: float = 2.0) -> Optional[Path]:
+    """Create a temporary directory on RAM-backed storage (`/dev/shm` or 
+    `$XDG_RUNTIME_DIR`) that intermediate visibility files may be written to, 
+    provided there is enough free space. 
+
+    Args:
+        miriad_vis (Path): The miriad visibility file that intermediate products will be derived from
+        headroom (float, optional): Required free space as a multiple of the size of `miriad_vis`. Defaults to 2.0.
+
+    Returns:
+        Optional[Path]: The created temporary directory, or None if no suitable location was found
+    """
+    vis_size = sum(
+        entry.stat().st_size for entry in os.scandir(miriad_vis) if entry.is_file()
+    )
+
+    candidates = [Path("/dev/shm")]
+    if "XDG_RUNTIME_DIR" in os.environ:
+        candidates.append(Path(os.environ["XDG_RUNTIME_DIR"]))
+
+    for candidate in candidates:
+        if not candidate.is_dir() or not os.access(candidate, os.W_OK):
+            continue
+        if shutil.disk_usage(candidate).free < vis_size * headroom:
+            logger.debug(f"Not enough free space in {candidate} for {miriad_vis}")
+            continue
+
+        scratch_dir = Path(tempfile.mkdtemp(prefix="glass_vis2ms_", dir=candidate))
+        logger.info(f"Using {scratch_dir} for intermediate files")
+        return scratch_dir
+
+    return None
+
+    
 def extract_field_name(miriad_vis: Path) -> str:
     """Parses the name of a miriad visibilty file to extract the 
     name of the field. This assumes to (miriad standard) naming 
@@ -76,7 +120,7 @@ def extract_field_name(miriad_vis: Path) -> str:
         str: Extract field name
     """
     logger.info(f"Extracting field name from {miriad_vis}")
-    name = miriad_vis.name.split(".")[0]
+    name = field_from_name(miriad_vis.name)
 
     logger.info(f"Field name extracted {name}")
 
@@ -89,7 +133,10 @@ def convert_miriad_to_ms(
     clean_up: bool = True,
     field_out: bool = False,
     field_name: Optional[str] = None,
-    force_conformant_ms: bool = False
+    force_conformant_ms: bool = False,
+    skip_uvaver: bool = False,
+    uvaver_opts: Optional[List[str]] = None,
+    use_scratch: bool = True,
 ) -> Path:
     """Converts a miriad visibility file into a measurement set. Temporary files
     created in this process can optionally be removed. Internally the CASA task
@@ -102,10 +149,15 @@ def convert_miriad_to_ms(
         field_out (bool, optional): Create a folder for the field to place the measurement set into. If True and `field_name` is unset the name is extracted from the miriad visibility name. Defaults to False.
         field_name (Optional[str], optional): Provide a specific field name. Defaults to None.
         force_conformant_ms (bool, optional): Attempt to applied data cleaning operations to ensure the output measurement set is correctly formed. This is largely unnecesssary since `importmiriad` was adopted. Defaults to False.
+        skip_uvaver (bool, optional): Pass `miriad_vis` directly to `importmiriad` without first running `uvaver`. Only appropriate when there are no calibration tables to apply and no averaging is needed. Defaults to False.
+        uvaver_opts (Optional[List[str]], optional): Additional arguments (e.g. `interval=...`) passed to `uvaver`. Defaults to None.
+        use_scratch (bool, optional): Write the intermediate `uvaver` output to RAM-backed scratch space when there is room and `clean_up` is set. Defaults to True.
 
     Returns:
         Path: Path to the output measurement set. 
     """
+    from casatasks import importmiriad
+
     # will raise error when does not exist
     ensure_dir_exists(miriad_vis)
 
@@ -120,26 +172,105 @@ def convert_miriad_to_ms(
         logger.info(f"Creating output folder {output_dir}")
         output_dir.mkdir(parents=True)
 
-    logger.info("Running avaver")
-    uvaver_out = output_dir / miriad_vis.name
-    call([f"uvaver", f"vis='{str(miriad_vis)}'", f"out='{str(uvaver_out)}'"])
-
-    ms_out = uvaver_out.with_suffix(miriad_vis.suffix + ".ms")
-    logger.info(f"Converting to MS {ms_out}")
-    importmiriad(mirfile=str(uvaver_out), vis=str(ms_out), tsys=True)
+    scratch_dir = None
+    if skip_uvaver:
+        # uvaver writes a full copy of the visibilities, which is unnecessary
+        # when there are no calibration tables to apply or averaging to perform
+        logger.info(f"Skipping uvaver, converting {miriad_vis} directly")
+        uvaver_out = miriad_vis
+    else:
+        # The intermediate uvaver output is only needed by importmiriad, so when it
+        # will be removed it is placed on RAM-backed scratch space if possible
+        scratch_dir = get_scratch_dir(miriad_vis) if clean_up and use_scratch else None
+        uvaver_out = (output_dir if scratch_dir is None else scratch_dir) / miriad_vis.name
+
+    ms_out = (output_dir / miriad_vis.name).with_suffix(miriad_vis.suffix + ".ms")
+    try:
+        if not skip_uvaver:
+            logger.info("Running avaver")
+            with stage_timer("uvaver"):
+                call([f"uvaver", f"vis='{str(miriad_vis)}'", f"out='{str(uvaver_out)}'"] + (uvaver_opts or []))
+
+        logger.info(f"Converting to MS {ms_out}")
+        with stage_timer("importmiriad"):
+            importmiriad(mirfile=str(uvaver_out), vis=str(ms_out), tsys=True)
+    finally:
+        # The copy of the visibilities must not be left in memory should a step fail
+        if scratch_dir is not None:
+            logger.info(f"Removing scratch directory {scratch_dir}")
+            remove_files_folders([scratch_dir])
 
     if force_conformant_ms:
-        remove_nonconformant_timesteps(ms_out)        
+        with stage_timer("remove_nonconformant_timesteps"):
+            remove_nonconformant_timesteps(ms_out)        
 
     logger.info(f"Finished creating {ms_out}")
 
-    if clean_up:
+    if clean_up and not skip_uvaver and scratch_dir is None:
         logger.info(f"Cleaning up files")
         remove_files_folders([uvaver_out])
         
     return ms_out
 
 
+def convert_miriad_to_ms_batch(
+    miriad_vises: List[Path], jobs: int = 1, **kwargs
+) -> List[Path]:
+    """Convert a set of miriad visibility files into measurement sets, using 
+    up to `jobs` concurrent worker processes. A failed conversion is logged
+    and does not stop the remaining conversions. All other keyword arguments
+    are passed to `convert_miriad_to_ms`. RAM-backed scratch space is only
+    used when conversions run one at a time. 
+
+    Args:
+        miriad_vises (List[Path]): Miriad visibility files to convert
+        jobs (int, optional): Number of conversions to run concurrently. Defaults to 1.
+
+    Returns:
+        List[Path]: Measurement sets that were successfully created
+    """
+    ms_outs = []
+
+    def collect(conversions: Iterable[Tuple[Path, Callable[[], Path]]]) -> None:
+        for miriad_vis, conversion in conversions:
+            try:
+                ms_out = conversion()
+            except Exception as e:
+                logger.error(f"Failed to convert {miriad_vis}: {e}")
+                continue
+
+            logger.info(f"Converted {miriad_vis} to {ms_out}")
+            ms_outs.append(ms_out)
+
+    if jobs <= 1:
+        collect(
+            (miriad_vis, partial(convert_miriad_to_ms, miriad_vis=miriad_vis, **kwargs))
+            for miriad_vis in miriad_vises
+        )
+    else:
+        # Each worker checks for free scratch space at the same moment, so several
+        # could commit to the same headroom and exhaust it
+        kwargs["use_scratch"] = False
+
+        # CASA holds global state and is not fork-safe, so each conversion is
+        # run in a freshly spawned process
+        with ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=get_context("spawn"),
+            initializer=set_worker_log_level,
+            initargs=(logger.getEffectiveLevel(),),
+        ) as executor:
+            futures = {
+                executor.submit(convert_miriad_to_ms, miriad_vis=miriad_vis, **kwargs): miriad_vis
+                for miriad_vis in miriad_vises
+            }
+            collect((futures[future], future.result) for future in as_completed(futures))
+
+    logger.info(f"Converted {len(ms_outs)} of {len(miriad_vises)} visibility files")
+
+    return ms_outs
+
+
 def get_parser() -> ArgumentParser:
     """Generates the arguement parser for the glass_vis2ms task. 
 
@@ -153,7 +284,8 @@ def get_parser() -> ArgumentParser:
     parser.add_argument(
         "miriad_vis",
         type=Path,
-        help="Path to the miriad visibility file to convert to a measurement set",
+        nargs="+",
+        help="Path to the miriad visibility file(s) to convert to a measurement set",
     )
     parser.add_argument(
         "-c",
@@ -179,6 +311,18 @@ def get_parser() -> ArgumentParser:
         default=None,
         help="Name of the field. If None, attempt to dereive it from the miriad file name. ",
     )
+    parser.add_argument(
+        "--skip-uvaver",
+        action="store_true",
+        help="Convert the visibility file directly without first running uvaver. Calibration tables will not be applied. ",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of visibility files to convert concurrently",
+    )
     parser.add_argument(
         '-v', '--verbose', action='store_true', help='Produce more verbose messages'
     )
@@ -196,14 +340,22 @@ def cli() -> None:
     if args.verbose:
         logger.setLevel(logging.DEBUG)
 
-    convert_miriad_to_ms(
-        miriad_vis=args.miriad_vis,
+    if args.field_name is not None and len(args.miriad_vis) > 1:
+        parser.error("--field-name may only be used with a single visibility file")
+
+    ms_outs = convert_miriad_to_ms_batch(
+        miriad_vises=args.miriad_vis,
+        jobs=args.jobs,
         output_dir=args.output_dir,
         clean_up=args.clean_up,
         field_out=args.field_out,
         field_name=args.field_name,
+        skip_uvaver=args.skip_uvaver,
     )
 
+    if len(ms_outs) < len(args.miriad_vis):
+        sys.exit(1)
+
 
 if __name__ == "__main__":
     cli()
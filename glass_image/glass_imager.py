@@ -1,47 +1,66 @@
 """The main script runner for GLASS imager
 """
 import os
+import sys
 import shutil
 import logging
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
 from pathlib import Path
-from typing import Optional, NamedTuple
+from typing import Optional, NamedTuple, List
 
 from glass_image import WSCLEANDOCKER
-from glass_image.wsclean import (
-    pull_wsclean_container,
-    generate_wsclean_cmd,
-    run_wsclean_cmd,
-)
-from glass_image.logging import logger
-from glass_image.pointing import Pointing
-from glass_image.casa_selfcal import derive_apply_selfcal
-from glass_image.configuration import get_imager_options, get_round_options
+from glass_image.logging import logger, set_worker_log_level
+from glass_image.pointing import Pointing, field_from_name
+from glass_image.configuration import get_imager_options, get_all_round_options
 from glass_image.options import ImagerOptions, WSCleanOptions
-from glass_image.utils import zip_folder
+from glass_image.utils import zip_folder, wait_for_background_removals, stage_timer, get_available_cores, require_exists
 
 def image_round(
     wsclean_img: Path,
     point: Pointing,
     wsclean_options: WSCleanOptions,
     clean_up: bool = True,
+    cores: Optional[int] = None,
+    parallel_stages: bool = False,
+    concurrent_jobs: int = 1,
+    persistent: bool = False,
+    temp_dir: Optional[Path] = None,
 ) -> None:
+    from glass_image.wsclean import generate_wsclean_cmd, run_wsclean_cmd
+
     logger.info(f"Will be imaging {point}")
     logger.info(f"Using container: {wsclean_img=}")
 
+    if cores is not None:
+        wsclean_options = wsclean_options._replace(cores=cores)
+    if temp_dir is not None:
+        wsclean_options = wsclean_options._replace(temp_dir=str(temp_dir))
+    if concurrent_jobs > 1:
+        # The memory limit is for the whole machine, which is shared with the other jobs
+        wsclean_options = wsclean_options._replace(
+            absmem=max(wsclean_options.absmem // concurrent_jobs, 1)
+        )
+
     wsclean_cmd = generate_wsclean_cmd(
         point=point, options=wsclean_options
     )
 
     output_dir = Path(f"round_{wsclean_options.round}") if wsclean_options.round > 0 else Path("no_selfcal")
-    assert not output_dir.exists(), f"Output folder {output_dir} already exists. "
+    # Creating the folder up front is a single call that raises a FileExistsError
+    # should the output folder already exist
+    output_dir.mkdir(parents=False, exist_ok=False)
 
-    run_wsclean_cmd(
-        wsclean_img=wsclean_img,
-        wsclean_cmd=wsclean_cmd,
-        move_into=output_dir,
-        clean_up=clean_up,
-    )
+    with stage_timer(f"wsclean round {wsclean_options.round}"):
+        run_wsclean_cmd(
+            wsclean_img=wsclean_img,
+            wsclean_cmd=wsclean_cmd,
+            move_into=output_dir,
+            clean_up=clean_up,
+            background_clean_up=parallel_stages,
+            persistent=persistent,
+        )
 
 
 def image_cband(
@@ -50,9 +69,24 @@ def image_cband(
     workdir: Optional[Path] = None,
     wsclean_img: Optional[Path] = None,
     clean_up: bool = True,
+    cores: Optional[int] = None,
+    parallel_stages: bool = False,
+    concurrent_jobs: int = 1,
+    temp_dir: Optional[Path] = None,
 ) -> None:
-    assert ms_path.exists(), f"MS {ms_path} does not exist"
-    assert imager_config.exists(), f"Imager configuration {imager_config} does not exist"
+    from glass_image.wsclean import pull_wsclean_container
+    from glass_image.casa_selfcal import derive_apply_selfcal
+
+    require_exists(ms_path, imager_config)
+
+    # Used to overlap the container pull and the zipping of earlier
+    # measurement sets with the set up and imaging work
+    executor = ThreadPoolExecutor(max_workers=2)
+
+    container_future = None
+    if wsclean_img is None:
+        logger.info("No wsclean-image provided. Will attempt to download. ")
+        container_future = executor.submit(pull_wsclean_container)
 
     if workdir is not None:
         logger.info(f"Changing directory to: {workdir}")
@@ -62,43 +96,54 @@ def image_cband(
 
     # Make a copy of the configuration file to the work directory
     dest_config_file = workdir / imager_config.name 
-    if imager_config != dest_config_file: 
+    # Compare the files rather than the paths, which may differ through 
+    # symbolic links or relative components
+    try:
+        same_config = imager_config.samefile(dest_config_file)
+    except FileNotFoundError:
+        same_config = False
+
+    if not same_config: 
         if dest_config_file.exists():
             logger.warn(f"Removing existing {dest_config_file}. ")
         shutil.copy(imager_config, dest_config_file)
 
     logger.debug(f"Input MS: {ms_path}")
-    name_comps = ms_path.name.split(".")
-    logger.debug(f"{name_comps}")
-    field = "_".join(name_comps[:1])
+    field = field_from_name(ms_path.name)
+    logger.debug(f"Field name: {field}")
 
     point = Pointing(workdir=workdir, field=field, ms=ms_path)
-
-    if wsclean_img is None:
-        logger.info("No wsclean-image provided. Will attempt to download. ")
-        wsclean_img = pull_wsclean_container()
-
     logger.info(f"Formed point: {point}")
-    logger.info(f"WSClean image: {wsclean_img}")
 
     logger.debug(f"Getting Imager related options.")
     imager_options = ImagerOptions(**get_imager_options(imager_config))
     
-    img_round_options = get_round_options(imager_config, img_round=0)
+    all_round_options = get_all_round_options(imager_config, n_rounds=imager_options.rounds+1)
+    img_round_options = all_round_options[0]
+
+    if container_future is not None:
+        wsclean_img = container_future.result()
+    logger.info(f"WSClean image: {wsclean_img}")
+
+    zip_futures = []
 
     image_round(
-        wsclean_img=wsclean_img, point=point, wsclean_options=img_round_options.wsclean
+        wsclean_img=wsclean_img, point=point, wsclean_options=img_round_options.wsclean, cores=cores,
+        parallel_stages=parallel_stages, concurrent_jobs=concurrent_jobs, persistent=True,
+        temp_dir=temp_dir,
     )
 
     # Remember the range command is not inclusive
     for img_round in range(1, imager_options.rounds+1):
-        img_round_options = get_round_options(imager_config, img_round=img_round)
+        img_round_options = all_round_options[img_round]
         
         logger.info(f"\n\nAttempting selcalibration for round {img_round}")
-        selfcal_point = derive_apply_selfcal(
-            in_point=point, 
-            options=img_round_options.casasc
-        )
+        with stage_timer(f"selfcal round {img_round}"):
+            selfcal_point = derive_apply_selfcal(
+                in_point=point, 
+                options=img_round_options.casasc,
+                cores=cores,
+            )
 
         logger.info(f"\n\nRunning imaging for round {img_round}")
         image_round(
@@ -106,28 +151,173 @@ def image_cband(
             point=selfcal_point,
             wsclean_options=img_round_options.wsclean,
             clean_up=imager_options.clean_up,
+            cores=cores,
+            parallel_stages=parallel_stages,
+            concurrent_jobs=concurrent_jobs,
+            persistent=True,
+            temp_dir=temp_dir,
         )
 
         if img_round > 1:
-            zip_folder(point.ms, point.ms.with_suffix(point.ms.suffix + '.zip'))
+            # The previous measurement set is no longer needed, so zip it
+            # while the next round carries on
+            zip_futures.append(
+                executor.submit(zip_folder, point.ms, point.ms.with_suffix(point.ms.suffix + '.zip'))
+            )
 
         logger.info(f"\n\nUpdating current MS from {point.ms} to {selfcal_point.ms}")
         point = selfcal_point
 
     zip_folder(point.ms, point.ms.with_suffix(point.ms.suffix + '.zip'))
 
+    # Raise any errors from the background zips
+    for zip_future in zip_futures:
+        zip_future.result()
+    executor.shutdown()
+
+    wait_for_background_removals()
+
     logger.info(f"\n\nFinished imaging {str(ms_path)}.")
 
-def get_parser() -> ArgumentParser:
+
+def _init_worker(log_level: int, cpu_sets=None) -> None:
+    """Set up a worker process. The log level of the parent is applied, and the
+    worker is restricted to the next unclaimed set of CPUs, so that concurrent 
+    fields do not contend for the same cores. 
+
+    Args:
+        log_level (int): The logging level of the parent process
+        cpu_sets (Optional[Queue], optional): Sets of CPU indices, one claimed by each worker. Defaults to None, which does not pin the worker.
+    """
+    set_worker_log_level(log_level)
+    if cpu_sets is None:
+        return
+
+    cpus = cpu_sets.get()
+    os.sched_setaffinity(0, cpus)
+    logger.debug(f"Worker {os.getpid()} pinned to CPUs {sorted(cpus)}")
+
+
+def image_cband_batch(
+    ms_paths: List[Path],
+    imager_config: Path,
+    workdir: Optional[Path] = None,
+    wsclean_img: Optional[Path] = None,
+    jobs: int = 1,
+    **kwargs,
+) -> List[Path]:
+    """Image a set of measurement sets, using up to `jobs` concurrent worker 
+    processes. Each measurement set is processed in its own sub-directory of 
+    `workdir`, named after the measurement set without its `.ms` extension, so 
+    that the products of different measurement sets (including those of the 
+    same field) do not collide. A failed measurement set is logged and does not
+    stop the remaining ones. All other keyword arguments are passed to `image_cband`. 
+
+    Where supported, the available CPUs are split evenly between the workers
+    and each worker is pinned to its share. Unless `cores` is given, wsclean
+    uses the cores of its share, and its memory limit is divided by `jobs`. 
+
+    Args:
+        ms_paths (List[Path]): Measurement sets to image
+        imager_config (Path): Path to the imager configuration file
+        workdir (Optional[Path], optional): Directory the per-measurement set directories are created in. Defaults to None, the current directory.
+        wsclean_img (Optional[Path], optional): Path to singularity image containing wsclean. Defaults to None.
+        jobs (int, optional): Number of fields to image concurrently. Defaults to 1.
+
+    Returns:
+        List[Path]: Measurement sets that were successfully imaged
+
+    Raises:
+        ValueError: Raised when two measurement sets share a name
+    """
+    from glass_image.wsclean import pull_wsclean_container
+
+    workdir = Path(os.getcwd() if workdir is None else workdir).absolute()
+
+    ms_stems = [ms_path.stem for ms_path in ms_paths]
+    duplicates = sorted({stem for stem in ms_stems if ms_stems.count(stem) > 1})
+    if len(duplicates) > 0:
+        raise ValueError(f"Measurement sets would share a working directory: {duplicates}")
+
+    # Pull once up front, rather than having every worker race to do so
+    if wsclean_img is None:
+        logger.info("No wsclean-image provided. Will attempt to download. ")
+        wsclean_img = pull_wsclean_container()
+
+    ms_workdirs = {}
+    for ms_path in ms_paths:
+        ms_workdir = workdir / ms_path.stem
+        ms_workdir.mkdir(parents=True, exist_ok=True)
+        ms_workdirs[ms_path] = ms_workdir
+
+    mp_context = get_context("spawn")
+    initargs = (logger.getEffectiveLevel(),)
+    if jobs > 1:
+        kwargs["concurrent_jobs"] = jobs
+        if hasattr(os, "sched_setaffinity"):
+            cpus = sorted(os.sched_getaffinity(0))
+            per_job = max(len(cpus) // jobs, 1)
+            cpu_sets = mp_context.Queue()
+            for job in range(jobs):
+                cpu_sets.put(set(cpus[job * per_job:(job + 1) * per_job] or cpus))
+            initargs = (logger.getEffectiveLevel(), cpu_sets)
+        else:
+            per_job = max(get_available_cores() // jobs, 1)
+        if kwargs.get("cores") is None:
+            kwargs["cores"] = per_job
+
+    imaged = []
+    # CASA holds global state and is not fork-safe, and image_cband changes
+    # into its work directory, so each field is run in a freshly spawned process
+    with ProcessPoolExecutor(
+        max_workers=jobs, mp_context=mp_context, initializer=_init_worker, initargs=initargs
+    ) as executor:
+        futures = {
+            executor.submit(
+                image_cband,
+                ms_path=ms_path.absolute(),
+                imager_config=imager_config,
+                workdir=ms_workdirs[ms_path],
+                wsclean_img=wsclean_img,
+                **kwargs,
+            ): ms_path
+            for ms_path in ms_paths
+        }
+        for future in as_completed(futures):
+            ms_path = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Failed to image {ms_path}: {e}")
+                continue
+
+            imaged.append(ms_path)
+
+    logger.info(f"Imaged {len(imaged)} of {len(ms_paths)} measurement sets")
+
+    return imaged
+
+
+def get_parser(batch: bool = False) -> ArgumentParser:
     parser = ArgumentParser(description="A simple imaging script for GLASS data")
 
-    parser.add_argument("ms", type=Path, help="Path to the field to image")
+    if batch:
+        parser.add_argument("ms", type=Path, nargs="+", help="Paths to the fields to image")
+        parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=1,
+            help="Number of fields to image concurrently",
+        )
+    else:
+        parser.add_argument("ms", type=Path, help="Path to the field to image")
     parser.add_argument(
         "-w",
         "--workdir",
         type=Path,
         default=None,
-        help="Where to carry out the processing",
+        help="Where to carry out the processing. In batch mode each field is processed in a sub-directory named after the field. ",
     )
     parser.add_argument(
         "-v", "--verbose", action="store_true", help="Enable verbose logging"
@@ -138,6 +328,23 @@ def get_parser() -> ArgumentParser:
         default=None,
         help=f"Path to the wsclean singularity container. If not provided will attempt to download {WSCLEANDOCKER}, a slightly modified wsclean image. ",
     )
+    parser.add_argument(
+        "--cores",
+        type=int,
+        default=None,
+        help="Number of cores wsclean may use. If not provided all available cores are used. Gridding and reordering threads are derived from this unless set in the configuration. ",
+    )
+    parser.add_argument(
+        "--parallel-stages",
+        action="store_true",
+        help="Remove intermediate wsclean products in the background, so the next self-calibration round starts without waiting on them. ",
+    )
+    parser.add_argument(
+        "--temp-dir",
+        type=Path,
+        default=None,
+        help="Directory wsclean writes its reordered visibilities into, e.g. node-local scratch. Overrides the temp_dir of the configuration. If neither is set they are written to the working directory. ",
+    )
     parser.add_argument(
         "imager_config",
         type=Path,
@@ -161,8 +368,34 @@ def cli() -> None:
         workdir=args.workdir,
         wsclean_img=args.wsclean_image,
         imager_config=args.imager_config.absolute(),
+        cores=args.cores,
+        parallel_stages=args.parallel_stages,
+        temp_dir=args.temp_dir,
+    )
+
+
+def batch_cli() -> None:
+    parser = get_parser(batch=True)
+
+    args = parser.parse_args()
+
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
+
+    imaged = image_cband_batch(
+        ms_paths=args.ms,
+        workdir=args.workdir,
+        wsclean_img=args.wsclean_image,
+        imager_config=args.imager_config.absolute(),
+        jobs=args.jobs,
+        cores=args.cores,
+        parallel_stages=args.parallel_stages,
+        temp_dir=args.temp_dir,
     )
 
+    if len(imaged) < len(args.ms):
+        sys.exit(1)
+
 
 if __name__ == "__main__":
     cli()
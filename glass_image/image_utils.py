@@ -1,18 +1,53 @@
 """Helper functions related to interation with image data,
 primarily in the FITS image format. 
 """
+import io
+import os
 from pathlib import Path
+from typing import TYPE_CHECKING, Any, Optional, Tuple
 
 import numpy as np
-from astropy.wcs import WCS
 from astropy.io import fits
-from reproject import reproject_interp
+
+if TYPE_CHECKING:
+    # astropy.wcs (and wcslib) is only imported once a mask is extracted, so
+    # that users of the lighter helpers (e.g. `find_fits_mask`) do not pay for it
+    from astropy.wcs import WCS
+
+try:
+    import fitsio
+except ImportError:
+    fitsio = None
 
 from glass_image.logging import logger
 from glass_image.pointing import Pointing
 from glass_image.errors import FITSCleanMaskNotFound
 from glass_image.options import ImageRoundOptions
 
+# Number of output rows whose input pixels are computed at a time
+MAPPING_STRIP_ROWS = 256
+
+def write_fits_image(out_path: Path, data: np.ndarray, header: fits.header.Header) -> Path:
+    """Write an image and header to a FITS file. The file is first assembled in 
+    memory and then written with a single call, rather than astropy issuing many
+    small writes, which is slow on network filesystems. An existing file is 
+    overwritten. 
+
+    Args:
+        out_path (Path): Location of the FITS file to write
+        data (np.ndarray): The image data
+        header (fits.header.Header): Header of the image
+
+    Returns:
+        Path: Location of the written FITS file
+    """
+    buffer = io.BytesIO()
+    fits.PrimaryHDU(data=data, header=header).writeto(buffer)
+    Path(out_path).write_bytes(buffer.getbuffer())
+
+    return Path(out_path)
+
+
 def find_fits_mask(point: Pointing) -> Path:
     """Searches and returns the Path to the clean mask. The initial signal-cut
     mask is intended to be produced from the larger mosaic co-add of all data. 
@@ -27,13 +62,273 @@ def find_fits_mask(point: Pointing) -> Path:
     """
     out_path = Path(f"{point.field}_clean_mask.fits")
 
-    if not out_path.exists():
+    try:
+        os.stat(out_path)
+    except FileNotFoundError:
         raise FITSCleanMaskNotFound(out_path)
     
     return out_path
 
 
-def cutout_mask(image_header: fits.header.Header, mosaic_mask: Path, point: Pointing, options: ImageRoundOptions) -> Path:
+def get_clean_mask_path(point: Pointing) -> Path:
+    """Path that the clean mask extracted for a pointing is written to
+
+    Args:
+        point (Pointing): Measurement set pointing the clean mask corresponds to
+
+    Returns:
+        Path: Location of the clean mask, alongside the measurement set
+    """
+    return point.ms.parent / Path(f"{point.field}_clean_mask.fits")
+
+
+def clean_mask_is_current(clean_mask: Path, mosaic_mask: Path, size: int) -> bool:
+    """Check whether an extracted clean mask exists, is newer than the mosaic 
+    mask it would be extracted from, and matches the size of the image it 
+    would be used with. 
+
+    Args:
+        clean_mask (Path): The extracted clean mask
+        mosaic_mask (Path): The larger mask the clean mask is extracted from
+        size (int): Size of the image in pixels along one axis
+
+    Returns:
+        bool: Whether the clean mask may be reused
+    """
+    try:
+        clean_mask_mtime = os.stat(clean_mask).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+    if clean_mask_mtime <= os.stat(mosaic_mask).st_mtime_ns:
+        return False
+
+    # The image size may have changed in the imager configuration since
+    header = fits.getheader(str(clean_mask))
+    if (header.get("NAXIS1"), header.get("NAXIS2")) != (size, size):
+        logger.info(f"Clean mask {clean_mask} does not match the image size of {size}")
+        return False
+
+    return True
+
+
+def _aligned_pixel_offset(mosaic_wcs: "WCS", target_wcs: "WCS") -> Optional[Tuple[int, int]]:
+    """Determine whether two celestial WCS share the same pixel grid, i.e. the same
+    projection, reference coordinate and pixel scale, with reference pixels that 
+    differ by a whole number of pixels. 
+
+    Args:
+        mosaic_wcs (WCS): The celestial WCS of the larger image
+        target_wcs (WCS): The celestial WCS of the image to extract
+
+    Returns:
+        Optional[Tuple[int, int]]: The (x, y) pixel of the mosaic that corresponds to pixel (0, 0) of the target, or None if the grids are not aligned
+    """
+    mosaic, target = mosaic_wcs.wcs, target_wcs.wcs
+    if (
+        mosaic_wcs.has_distortion
+        or target_wcs.has_distortion
+        or list(mosaic.ctype) != list(target.ctype)
+        or not np.allclose(mosaic.crval, target.crval)
+        or not np.allclose(mosaic_wcs.pixel_scale_matrix, target_wcs.pixel_scale_matrix)
+    ):
+        return None
+
+    offset = mosaic.crpix - target.crpix
+    if not np.allclose(offset, np.round(offset)):
+        return None
+
+    return int(round(offset[0])), int(round(offset[1]))
+
+
+def _as_mask(data: np.ndarray) -> np.ndarray:
+    """Convert image data to a compact mask, where pixels that are finite and 
+    non-zero are set to 1. 
+
+    Args:
+        data (np.ndarray): Image data to convert
+
+    Returns:
+        np.ndarray: The mask as an array of uint8
+    """
+    data = np.asarray(data)
+    if data.dtype == np.uint8:
+        # Already a compact mask, e.g. one previously produced by this function
+        return np.minimum(data, 1)
+
+    # The comparisons are written directly into the uint8 output, avoiding
+    # a copy of the image
+    out = np.empty(data.shape, dtype=np.uint8)
+    mask = out.view(np.bool_)
+    if data.dtype.kind == "f":
+        # Comparisons against NaN are False, so NaNs are excluded from the mask.
+        # A single boolean scratch array holds the second comparison
+        np.greater(data, 0, out=mask)
+        scratch = np.empty(data.shape, dtype=np.bool_)
+        np.less(data, 0, out=scratch)
+        np.logical_or(mask, scratch, out=mask)
+    else:
+        np.not_equal(data, 0, out=mask)
+
+    return out
+
+
+def _read_region(hdu: fits.ImageHDU, x0: int, y0: int, shape: Tuple[int, int]) -> np.ndarray:
+    """Read a region of the last two axes of an image HDU. Only the pixels
+    within the region are read from disk (through `section`), and any scaling
+    is applied to those pixels alone. Any leading (degenerate) axes are taken 
+    at their first plane. Pixels outside of the image are set to zero. 
+
+    Args:
+        hdu (fits.ImageHDU): The image to read from
+        x0 (int): Pixel along the x-axis of the image that corresponds to the first pixel of the output
+        y0 (int): Pixel along the y-axis of the image that corresponds to the first pixel of the output
+        shape (Tuple[int, int]): Shape of the output image
+
+    Returns:
+        np.ndarray: The extracted image
+    """
+    img_ny, img_nx = hdu.shape[-2:]
+    leading = (0,) * (len(hdu.shape) - 2)
+
+    ys, ye = max(y0, 0), min(y0 + shape[0], img_ny)
+    xs, xe = max(x0, 0), min(x0 + shape[1], img_nx)
+    if not (ys < ye and xs < xe):
+        return np.zeros(shape, dtype=np.uint8)
+
+    region = hdu.section[leading + (slice(ys, ye), slice(xs, xe))]
+    if region.shape == tuple(shape):
+        return region
+
+    out = np.zeros(shape, dtype=region.dtype)
+    out[ys - y0 : ye - y0, xs - x0 : xe - x0] = region
+
+    return out
+
+
+def _nearest_pixel_mapping(
+    input_wcs: "WCS", target_wcs: "WCS", input_shape: Tuple[int, int], shape_out: Tuple[int, int]
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Compute, for each pixel of the output grid, the nearest pixel of the input 
+    grid. Only output pixels that fall within the input image are mapped. The
+    output grid is processed in strips of rows, so the coordinate arrays never
+    span the whole grid. 
+
+    Args:
+        input_wcs (WCS): Celestial WCS of the input image
+        target_wcs (WCS): Celestial WCS of the output image
+        input_shape (Tuple[int, int]): Shape of the input image
+        shape_out (Tuple[int, int]): Shape of the output image
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: Flattened boolean mask of the output pixels that are mapped, and the corresponding y and x pixels of the input image
+    """
+    from astropy.wcs.utils import pixel_to_pixel
+
+    ny, nx = shape_out
+    valid = np.empty(ny * nx, dtype=np.bool_)
+    in_ys, in_xs = [], []
+    for y0 in range(0, ny, MAPPING_STRIP_ROWS):
+        y1 = min(y0 + MAPPING_STRIP_ROWS, ny)
+        out_y, out_x = np.mgrid[y0:y1, 0:nx]
+        in_x, in_y = pixel_to_pixel(target_wcs, input_wcs, out_x.ravel(), out_y.ravel())
+
+        # Pixel centres are at integer coordinates
+        with np.errstate(invalid="ignore"):
+            in_x = np.floor(in_x + 0.5)
+            in_y = np.floor(in_y + 0.5)
+            strip_valid = (
+                np.isfinite(in_x) & np.isfinite(in_y)
+                & (in_x >= 0) & (in_x < input_shape[1])
+                & (in_y >= 0) & (in_y < input_shape[0])
+            )
+
+        valid[y0 * nx:y1 * nx] = strip_valid
+        in_ys.append(in_y[strip_valid].astype(np.int32))
+        in_xs.append(in_x[strip_valid].astype(np.int32))
+
+    return valid, np.concatenate(in_ys), np.concatenate(in_xs)
+
+
+def _reproject_mask(
+    input_data: Tuple[np.ndarray, "WCS"], target_wcs: "WCS", shape_out: Tuple[int, int], backend: str = "astropy"
+) -> np.ndarray:
+    """Reproject a mask onto a new pixel grid using nearest-neighbour interpolation. 
+    
+    The `astropy` backend transforms the centre of every output pixel onto the input
+    grid with `astropy.wcs` and copies the nearest input pixel. The `dfreproject` 
+    backend batches the coordinate transformations as tensor operations, and will
+    use a GPU should one be available. Should it not be installed the `astropy` 
+    backend is used instead. 
+
+    Args:
+        input_data (Tuple[np.ndarray, WCS]): The mask and its celestial WCS
+        target_wcs (WCS): The celestial WCS to reproject onto
+        shape_out (Tuple[int, int]): Shape of the output mask
+        backend (str, optional): Either `astropy` or `dfreproject`. Defaults to "astropy".
+
+    Returns:
+        np.ndarray: The reprojected mask
+    """
+    if backend == "dfreproject":
+        try:
+            import torch
+            from dfreproject import calculate_reprojection
+        except ImportError:
+            logger.warning("dfreproject is not installed, falling back to astropy")
+        else:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+            logger.info(f"Reprojecting with dfreproject on {device}")
+
+            data, wcs = input_data
+            # Masks are compact integers, so float32 is sufficient
+            hdu = fits.PrimaryHDU(data=np.asarray(data, dtype=np.float32), header=wcs.to_header())
+            reprojected = calculate_reprojection(
+                source_hdus=hdu,
+                target_wcs=target_wcs,
+                shape_out=shape_out,
+                order="nearest",
+                device=device,
+            )
+
+            # The result is a tensor on `device`, which may be a GPU
+            return reprojected.detach().cpu().numpy()
+    
+    data, wcs = input_data
+    data = np.asarray(data)
+    valid, in_y, in_x = _nearest_pixel_mapping(wcs, target_wcs, data.shape, shape_out)
+
+    reprojected = np.zeros(shape_out, dtype=data.dtype)
+    reprojected.ravel()[valid] = data[in_y, in_x]
+
+    return reprojected
+
+
+def cutout_mask(image_header: fits.header.Header, mosaic_mask: Path, point: Pointing, options: ImageRoundOptions, force: bool = False, backend: str = "astropy") -> Path:
+    """Extract the region of a larger clean mask that corresponds to an image. Should
+    the pixel grids of the two be aligned the pixels are directly extracted. Otherwise
+    only the region of the mosaic that overlaps the image is reprojected, using
+    nearest-neighbour interpolation to preserve the values of the mask. 
+
+    An existing clean mask that is newer than `mosaic_mask` and of the expected 
+    size is reused unless `force` is set. 
+
+    Args:
+        image_header (fits.header.Header): Header of the image the mask will be used with
+        mosaic_mask (Path): Path to the larger clean mask to extract from
+        point (Pointing): Measurement set pointing the mask corresponds to
+        options (ImageRoundOptions): Imaging options, used to set the size of the output mask
+        force (bool, optional): Extract the clean mask even if an up-to-date one exists. Defaults to False.
+        backend (str, optional): Reprojection backend to use when the pixel grids are not aligned, either `astropy` or `dfreproject`. Defaults to "astropy".
+
+    Returns:
+        Path: Path to the extracted clean mask
+    """
+    out_path = get_clean_mask_path(point)
+    if not force and clean_mask_is_current(out_path, mosaic_mask, options.wsclean.size):
+        logger.info(f"Clean mask {out_path} is newer than {mosaic_mask}. Reusing it. ")
+        return out_path
+
     logger.info(f"Will be extracting clean mask from {mosaic_mask}")
     
     img_npix = options.wsclean.size
@@ -41,27 +336,91 @@ def cutout_mask(image_header: fits.header.Header, mosaic_mask: Path, point: Poin
     
     logger.debug(f"Output shape is {img_shape}")
     
-    with fits.open(str(mosaic_mask)) as mask_fits:
-        extract_img = reproject_interp(
-                (np.squeeze(mask_fits[0].data), WCS(mask_fits[0].header).celestial),
-                WCS(image_header).celestial,
-                shape_out=img_shape
-        )
+    from astropy.wcs import WCS
+
+    target_wcs = WCS(image_header).celestial
+
+    # Only the region of the mosaic being extracted is read, by tiles if the
+    # mosaic is compressed
+    with fits.open(str(mosaic_mask), memmap=True, mode="readonly") as mask_fits:
+        mask_hdu = mask_fits[0]
+        mosaic_wcs = WCS(mask_hdu.header).celestial
+
+        offset = _aligned_pixel_offset(mosaic_wcs, target_wcs)
+        if offset is not None:
+            logger.info(f"Mosaic mask and image are aligned, extracting with offset {offset}")
+            extract_img = _as_mask(_read_region(mask_hdu, offset[0], offset[1], img_shape))
+        else:
+            # Only the region of the mosaic covering the image is reprojected
+            ny, nx = img_shape
+            mosaic_ny, mosaic_nx = mask_hdu.shape[-2:]
+            corners = target_wcs.pixel_to_world(
+                np.array([-0.5, nx - 0.5, nx - 0.5, -0.5]),
+                np.array([-0.5, -0.5, ny - 0.5, ny - 0.5]),
+            )
+            mx, my = mosaic_wcs.world_to_pixel(corners)
+            pad = 2
+            if np.all(np.isfinite(mx)) and np.all(np.isfinite(my)):
+                x0 = max(int(np.floor(mx.min())) - pad, 0)
+                x1 = min(int(np.ceil(mx.max())) + pad + 1, mosaic_nx)
+                y0 = max(int(np.floor(my.min())) - pad, 0)
+                y1 = min(int(np.ceil(my.max())) + pad + 1, mosaic_ny)
+            else:
+                logger.debug(f"Unable to locate image corners in {mosaic_mask}, reprojecting the complete mosaic")
+                x0, x1, y0, y1 = 0, mosaic_nx, 0, mosaic_ny
+
+            if x0 < x1 and y0 < y1:
+                input_data = (
+                    _as_mask(_read_region(mask_hdu, x0, y0, (y1 - y0, x1 - x0))),
+                    mosaic_wcs.slice((slice(y0, y1), slice(x0, x1))),
+                )
+                extract_img = _as_mask(
+                    _reproject_mask(input_data, target_wcs, img_shape, backend=backend)
+                )
+            else:
+                logger.warning(f"Image does not overlap {mosaic_mask}, the clean mask will be empty")
+                extract_img = np.zeros(img_shape, dtype=np.uint8)
     
     logger.info(f"Extracted clean mask image. ")
     
-    out_path = point.ms.parent / Path(f"{point.field}_clean_mask.fits")
     logger.info(f"Writing mask image to {out_path}")
-    fits.writeto(
-        str(out_path),
-        extract_img[0],
-        image_header,
-        overwrite=True
-    )
+    # The uint8 data is written with BITPIX=8
+    write_fits_image(out_path, extract_img, image_header)
 
     return out_path
     
     
+def img_mad_with_header(fits_img: Path) -> Tuple[float, Any]:
+    """Compute the Median Absolute Deviation of an image, and return it alongside
+    the header of the image, so that the file only needs to be opened once. See
+    `img_mad`. 
+
+    Args:
+        fits_img (Path): Path to the FITS image to compute the MAD for. 
+
+    Returns:
+        Tuple[float, Any]: The MAD statistic in the same units as the pixel data, and the primary header (an astropy Header, or a fitsio FITSHDR when fitsio is installed), which supports card lookups by keyword
+    """
+    assert fits_img.suffix == '.fits', f"{fits_img} may not be a fits image. "
+
+    # A single private copy of the pixels is made, which the medians are then 
+    # allowed to partition in place and the deviations are written into. fitsio
+    # (cfitsio) reads directly into a new array, and is preferred when installed
+    if fitsio is not None:
+        data, header = fitsio.read(str(fits_img), ext=0, header=True)
+        data = data.ravel()
+    else:
+        with fits.open(str(fits_img)) as hdul:
+            header = hdul[0].header
+            data = np.array(hdul[0].data, copy=True).ravel()
+    
+    data_median = np.median(data, overwrite_input=True)
+    np.subtract(data, data_median, out=data)
+    np.abs(data, out=data)
+    
+    return np.median(data, overwrite_input=True), header
+
+
 def img_mad(fits_img: Path) -> float:
     """Compute the Median Absolute Deviation of an image. This does not 
     perform any type of sigma clipping, and will compute the MAD over the
@@ -74,11 +433,4 @@ def img_mad(fits_img: Path) -> float:
     Returns:
         float: The MAD statisitc in the same units as the pixel data
     """
-    assert fits_img.suffix == '.fits', f"{fits_img} may not be a fits image. "
-
-    data = fits.getdata(str(fits_img))
-    
-    data_median = np.median(data)
-    data_diff = np.abs(data - data_median)
-    
-    return np.median(data_diff)
+    return img_mad_with_header(fits_img)[0]
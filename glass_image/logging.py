@@ -8,3 +8,14 @@ logging.captureWarnings(True)
 logger = logging.getLogger("glass_image")
 logger.addHandler(logging.StreamHandler())
 logger.setLevel(logging.WARNING)
+
+
+def set_worker_log_level(level: int) -> None:
+    """Set the level of the logger in a worker process. A spawned worker imports
+    this module afresh, and so starts at the default level rather than the one 
+    set in the parent (e.g. with `--verbose`). 
+
+    Args:
+        level (int): The logging level of the parent process
+    """
+    logger.setLevel(level)
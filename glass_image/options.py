@@ -1,7 +1,8 @@
 """Location for all Option sytle classes
 """
 
-from typing import NamedTuple
+from pathlib import Path
+from typing import NamedTuple, Optional
 
 class ImagerOptions(NamedTuple):
     rounds: int = 5
@@ -10,6 +11,7 @@ class ImagerOptions(NamedTuple):
 class WSCleanCMD(NamedTuple):
     cmd: str
     outname: str
+    temp_dir: Optional[Path] = None
 
 class WSCleanOptions(NamedTuple):
     absmem: int = 100
@@ -29,6 +31,14 @@ class WSCleanOptions(NamedTuple):
     fit_spectral_pol: int = 4
     robust: float = 0.5
     stop_negative: bool = False
+    cores: Optional[int] = None
+    use_wgridder: bool = True
+    channels_out_factor: Optional[int] = None
+    bl_averaging: bool = False
+    max_peak_smearing: float = 0.25
+    parallel_gridding: Optional[int] = None
+    parallel_reordering: Optional[int] = None
+    temp_dir: Optional[str] = None
 
 class CasaSCOptions(NamedTuple):
     solint: str = "60s"
@@ -36,6 +46,8 @@ class CasaSCOptions(NamedTuple):
     calmode: str = "p"
     round: int = 0
     minsnr: float = 0.
+    casa_parallel: bool = False
+    drop_scratch_columns: bool = True
 
 class ImageRoundOptions(NamedTuple):
     wsclean: WSCleanOptions
@@ -8,9 +8,9 @@ from argparse import ArgumentParser
 
 from astropy.io import fits
 
-from glass_image.utils import remove_files_folders, call
+from glass_image.utils import remove_files_folders, call, call_chain
 from glass_image.logging import logger
-from glass_image.image_utils import img_mad
+from glass_image.image_utils import img_mad_with_header, write_fits_image
 
 
 def derive_weight_map(mir_app_img: Path, nu_bw: float, rms: float = 1.0) -> Path:
@@ -39,7 +39,7 @@ def derive_weight_map(mir_app_img: Path, nu_bw: float, rms: float = 1.0) -> Path
             f"out={str(mir_sens_img)}",
             "rms=1",
             "options=sensitivity",
-            f"bw={int(nu_bw/1e9)},10",
+            f"bw={round(nu_bw * 1e-9)},10",
             
         ]
     )
@@ -56,14 +56,14 @@ def derive_weight_map(mir_app_img: Path, nu_bw: float, rms: float = 1.0) -> Path
     )
 
     logger.info(f"Scaling weight map by rms-squared.")
-    with fits.open(str(fits_weight_img), mode="update") as open_fits_weight:
-        data = open_fits_weight[0].data
+    with fits.open(str(fits_weight_img)) as open_fits_weight:
+        header = open_fits_weight[0].header
         
         logger.info(f"Scaling weight by {rms}**2")
-        data = data**2.0 / rms**2.0
-        open_fits_weight[0].data = data
+        data = open_fits_weight[0].data**2.0 / rms**2.0
 
-        open_fits_weight.flush()
+    # Written in a single call, rather than round-tripping through update mode
+    write_fits_image(fits_weight_img, data, header)
 
     # Delete the files generated but not needed
     remove_files_folders([mir_sens_img, mir_weight_img])
@@ -76,11 +76,11 @@ def apply_miriad_pb(fits_app_img: Path) -> None:
         raise FileNotFoundError(f"The file {fits_app_img} does not exist. Exiting. ")
 
     logger.info(f"Estimating noise in {fits_app_img}.")
-    img_std = img_mad(fits_app_img) * 1.4826  # MAS to Std. Dev.
+    # The header is returned alongside the MAD, so the image is only opened once
+    img_mad, img_header = img_mad_with_header(fits_app_img)
+    img_std = img_mad * 1.4826  # MAS to Std. Dev.
     logger.info(f"Estimated noise is {img_std * 1000 * 1000:.2f}uJy")
 
-    img_header = fits.getheader(str(fits_app_img))
-
     nu_bw = img_header["CDELT3"]
     logger.info(f"Bandwidth of {fits_app_img} is {nu_bw} Hz")
 
@@ -91,21 +91,21 @@ def apply_miriad_pb(fits_app_img: Path) -> None:
     # Output fits image
     fits_int_img = fits_app_img.with_suffix(".pbcorr" + fits_app_img.suffix)
 
-    call(["fits", f"in={str(fits_app_img)}", f"out={str(mir_app_img)}", "op=xyin"])
-
-    logger.info("Image imported, running linmos. ")
-    call(
+    logger.info("Importing image, running linmos and exporting the FITS image. ")
+    call_chain(
         [
-            "linmos",
-            f"in={str(mir_app_img)}",
-            f"out={str(mir_int_img)}",
-            f"bw={int(nu_bw/1e9)},10",
-            f"rms={img_std}"
+            ["fits", f"in={str(fits_app_img)}", f"out={str(mir_app_img)}", "op=xyin"],
+            [
+                "linmos",
+                f"in={str(mir_app_img)}",
+                f"out={str(mir_int_img)}",
+                f"bw={round(nu_bw * 1e-9)},10",
+                f"rms={img_std}"
+            ],
+            ["fits", f"in={str(mir_int_img)}", f"out={str(fits_int_img)}", "op=xyout"],
         ]
     )
-
-    logger.info(f"Created {mir_int_img}, exporting FITS image.")
-    call(["fits", f"in={str(mir_int_img)}", f"out={str(fits_int_img)}", "op=xyout"])
+    logger.info(f"Created {fits_int_img}")
 
     derive_weight_map(mir_app_img=mir_app_img, nu_bw=nu_bw, rms=img_std)
 
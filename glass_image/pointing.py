@@ -1,11 +1,49 @@
 """Container object to hold a measurement set information
 """
 
+from functools import lru_cache
 from typing import NamedTuple
 from pathlib import Path
 
 
+@lru_cache(maxsize=None)
+def field_from_name(name: str) -> str:
+    """Extract the field name from the name of a visibility file or measurement
+    set, assuming the (miriad standard) naming convention of `field.frequency`
+
+    Args:
+        name (str): File name of the visibility file or measurement set
+
+    Returns:
+        str: The extracted field name
+    """
+    return name.split(".")[0]
+
+
 class Pointing(NamedTuple):
     workdir: Path
     field: str
     ms: Path
+
+    @property
+    def ms_suffix(self) -> str:
+        """The components of the measurement set name following the field, 
+        e.g. `1234.ms` for `field.1234.ms`
+        """
+        return ".".join(self.ms.name.split(".")[1:])
+
+
+def get_nchan(point: Pointing) -> int:
+    """The total number of channels across all spectral windows of the 
+    measurement set of a pointing
+
+    Args:
+        point (Pointing): The pointing whose measurement set is inspected
+
+    Returns:
+        int: The number of channels
+    """
+    from pyrap import tables
+
+    with tables.table(str(point.ms / "SPECTRAL_WINDOW"), ack=False) as spw_tab:
+        return int(sum(spw_tab.getcol("NUM_CHAN")))
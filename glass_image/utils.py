@@ -1,12 +1,27 @@
 """Utility functions to help with processing
 """
+import os
+import time
+import atexit
+import logging
+import shlex
 import shutil
+import stat
 import subprocess
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List, Optional
+from typing import Dict, Iterator, List, Optional
 
 from glass_image.logging import logger
 
+# Threads started by remove_files_folders_background that may still be running
+_BACKGROUND_REMOVALS: List[threading.Thread] = []
+
+# Accumulated wall-clock time, in nanoseconds, of each stage timed by stage_timer
+_STAGE_TIMINGS: Dict[str, int] = defaultdict(int)
+
 def zip_folder(in_path: Path, out_zip: Optional[Path] = None) -> None:
     """Zip a directory and remove the original. 
 
@@ -45,6 +60,92 @@ def ensure_dir_exists(target_dir: Path) -> None:
         raise ValueError(f"Although {target_dir} exists, it does not appear to be a miriad directory. ")
 
 
+def require_exists(*paths: Path) -> None:
+    """Ensure that each of the provided paths exists, using a single `stat` call per path
+
+    Args:
+        paths (Path): Paths that are required to exist
+
+    Raises:
+        FileNotFoundError: Raised listing every path that does not exist
+    """
+    missing = []
+    for path in paths:
+        try:
+            os.stat(path)
+        except FileNotFoundError:
+            missing.append(str(path))
+
+    if missing:
+        raise FileNotFoundError(f"Required paths do not exist: {', '.join(missing)}")
+
+
+def get_available_cores() -> int:
+    """Return the number of CPUs this process may run on. Where supported this 
+    respects the CPU affinity of the process (e.g. as set by a SLURM allocation),
+    rather than counting every CPU of the node. 
+
+    Returns:
+        int: The number of usable CPUs
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+
+    return os.cpu_count() or 1
+
+
+def clone_ms(src: Path, dst: Path) -> Path:
+    """Create a copy of a measurement set. A copy-on-write clone (reflink) is
+    attempted first, which on supporting filesystems (e.g. btrfs, XFS) is a
+    metadata only operation. Should that fail a regular recursive copy is made. 
+
+    Hard links are deliberately not used, as the clone is later modified in
+    place (e.g. MODEL_DATA and CORRECTED_DATA are written into it), which
+    would otherwise be written through to `src`. 
+
+    Args:
+        src (Path): The measurement set to clone
+        dst (Path): Location of the new measurement set
+
+    Returns:
+        Path: Path to the cloned measurement set
+    """
+    logger.info(f"Cloning {src} to {dst}")
+    try:
+        subprocess.run(
+            ["cp", "-r", "--reflink=always", str(src), str(dst)],
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        return dst
+    except (OSError, subprocess.CalledProcessError):
+        logger.debug(f"Reflink clone of {src} failed. Falling back to a full copy. ")
+        remove_files_folders([dst])
+
+    shutil.copytree(src, dst)
+
+    return dst
+
+
+def _fast_rmtree(path: str) -> None:
+    """Recursively remove a directory. `os.scandir` provides the entry type
+    from the directory listing, so no additional `stat` call is needed per
+    entry. Symbolic links are unlinked and never followed. 
+
+    Args:
+        path (str): Directory to remove
+    """
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                _fast_rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+
+    os.rmdir(path)
+
+
 def remove_files_folders(paths_to_remove: List[Path]) -> List[Path]:
     """Will remove a set of paths from the file system. If a Path points
     to a folder, it will be recursively removed. Otherwise it is simply
@@ -62,13 +163,17 @@ def remove_files_folders(paths_to_remove: List[Path]) -> List[Path]:
     file: Path
     for file in paths_to_remove:
         file = Path(file)
-        if not file.exists():
+        # A single lstat both checks for existence and identifies real 
+        # directories, without following symbolic links
+        try:
+            file_mode = os.lstat(file).st_mode
+        except FileNotFoundError:
             logger.debug(f"{file} does not exist. Skipping, ")
             continue
         
-        if file.is_dir():
+        if stat.S_ISDIR(file_mode):
             logger.info(f"Removing folder {str(file)}")
-            shutil.rmtree(file)
+            _fast_rmtree(str(file))
         else:
             logger.info(f"Removing file {file}.")
             file.unlink()
@@ -77,10 +182,40 @@ def remove_files_folders(paths_to_remove: List[Path]) -> List[Path]:
         
     return files_removed
 
+
+def remove_files_folders_background(paths_to_remove: List[Path]) -> threading.Thread:
+    """Remove a set of paths in a background thread, so that the caller is
+    not blocked while large folders (e.g. measurement sets) are deleted. The
+    thread is tracked and may be waited upon with `wait_for_background_removals`. 
+
+    Args:
+        paths_to_remove (List[Path]): Set of Paths that will be removed
+
+    Returns:
+        threading.Thread: The thread carrying out the removal
+    """
+    thread = threading.Thread(
+        target=remove_files_folders, args=(list(paths_to_remove),), daemon=False
+    )
+    thread.start()
+    _BACKGROUND_REMOVALS.append(thread)
+
+    return thread
+
+
+def wait_for_background_removals() -> None:
+    """Block until all removals started by `remove_files_folders_background` 
+    have finished. 
+    """
+    while _BACKGROUND_REMOVALS:
+        _BACKGROUND_REMOVALS.pop().join()
+
     
-def call(*args, **kwargs):
+def call(*args, **kwargs) -> subprocess.Popen:
     """Wrapper for subprocess.Popen to log the command and output
-    All arguments are passed to subprocess.Popen
+    All arguments are passed to subprocess.Popen. The process is waited on
+    once its output is exhausted, and returned so its exit status can be
+    inspected. 
     """
     # Call a subprocess, print the command to stdout
     logger.info(" ".join(args[0]))
@@ -90,8 +225,68 @@ def call(*args, **kwargs):
 
     with process.stdout:
         try:
-            for line in iter(process.stdout.readline, b""):
-                logger.info(line.decode("utf-8").strip())
+            if logger.isEnabledFor(logging.INFO):
+                for line in iter(process.stdout.readline, b""):
+                    logger.info(line.decode("utf-8").strip())
+            else:
+                # The output would not be logged, so drain it in large blocks
+                # without decoding or splitting into lines
+                fd = process.stdout.fileno()
+                while os.read(fd, 65536):
+                    pass
 
         except subprocess.CalledProcessError as e:
             logger.error(f"{str(e)}")
+
+    process.wait()
+
+    return process
+
+
+def call_chain(cmds: List[List[str]], **kwargs):
+    """Execute a sequence of dependent commands within a single shell, where
+    each command is only run if the previous one succeeded. This avoids
+    spawning a separate process from python for each step. Keyword arguments
+    are passed through to `call`. 
+
+    Args:
+        cmds (List[List[str]]): Commands to execute in order, each a list of arguments
+
+    Raises:
+        subprocess.CalledProcessError: Raised when a command in the chain exits with a non-zero status
+    """
+    chain = " && ".join(shlex.join(cmd) for cmd in cmds)
+    process = call(["sh", "-c", chain], **kwargs)
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, chain)
+
+
+@contextmanager
+def stage_timer(name: str) -> Iterator[None]:
+    """Accumulate the wall-clock time spent in a processing stage. This is
+    intended to wrap only major stages (e.g. `wsclean` or self-calibration),
+    not inner loops. A summary of all stages is logged on exit. 
+
+    Args:
+        name (str): Name of the stage being timed
+    """
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        _STAGE_TIMINGS[name] += time.perf_counter_ns() - start
+
+
+def log_stage_timings() -> None:
+    """Log the accumulated wall-clock time of each stage timed by `stage_timer`
+    """
+    if not _STAGE_TIMINGS:
+        return
+
+    logger.info("Stage timings:")
+    for name, elapsed in sorted(_STAGE_TIMINGS.items(), key=lambda item: -item[1]):
+        logger.info(f"    {name}: {elapsed * 1e-9:.2f}s")
+
+
+atexit.register(log_stage_timings)
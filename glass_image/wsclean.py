@@ -1,35 +1,171 @@
 """Simple wrapper to run a typical glass wsclean imaging
 """
 import os
+import re
+import atexit
+import math
+import time
+import shutil
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import NamedTuple, Optional
-from glob import glob
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 
 from spython.main import Client as sclient
 from astropy.io import fits
 
 from glass_image import WSCLEANDOCKER
 from glass_image.logging import logger
-from glass_image.pointing import Pointing
-from glass_image.utils import remove_files_folders
+from glass_image.pointing import Pointing, get_nchan
+from glass_image.utils import get_available_cores, remove_files_folders, remove_files_folders_background
 from glass_image.image_utils import find_fits_mask
 from glass_image.options import WSCleanCMD, WSCleanOptions
 
+# Angular size of an image pixel, in arcseconds
+PIXEL_SCALE_ARCSEC = 0.3
+# Number of concurrent moves of wsclean products across filesystems
+MAX_MOVE_WORKERS = 8
+# Runs of whitespace, including the newlines of multi-line command strings
+_WHITESPACE_RE = re.compile(r"\s+")
+# wsclean gridding sees little benefit beyond this many threads
+MAX_PARALLEL_GRIDDING = 16
+DEFAULT_PARALLEL_REORDERING = 4
+
+# The wsclean command, joined once at import. Optional groups of options 
+# are substituted as (possibly empty) strings
+_WSCLEAN_CMD_TEMPLATE = " ".join((
+    "wsclean",
+    "-abs-mem {absmem}",
+    "-mgain {mgain}",
+    "{mask_options}",
+    "-nmiter {nmiter}",
+    "-niter {niter}",
+    "-auto-threshold {autothresh}",
+    "-name {outname}",
+    "-size {size} {size}",
+    "-scale {scale}asec",
+    "-weight briggs {robust}",
+    "-pol I",
+    "{gridder}",
+    "{averaging}",
+    "-join-channels",
+    "{multiscale}",
+    "-channels-out {channels_out}",
+    "-fit-spectral-pol {fit_spectral_pol}",
+    "{other_options}",
+    "{parallel_options}",
+    "{temp_dir_options}",
+    "-data-column DATA",
+    "{MS}",
+))
+
+
+def get_wsclean_cache_path(image: str = WSCLEANDOCKER) -> Path:
+    """Return the path that a pulled container image is cached to. The directory
+    may be set with the `GLASS_WSCLEAN_CACHE_DIR` environment variable, and 
+    otherwise defaults to `~/.cache/glass_image`. The file name is derived from
+    the image reference, so a changed reference is pulled afresh. 
 
-def pull_wsclean_container() -> Path:
-    """Download the docker image for wsclean
+    Args:
+        image (str, optional): The container image reference. Defaults to WSCLEANDOCKER.
+
+    Returns:
+        Path: Location of the cached singularity container
+    """
+    cache_dir = Path(
+        os.environ.get("GLASS_WSCLEAN_CACHE_DIR", Path.home() / ".cache" / "glass_image")
+    )
+    digest = hashlib.sha256(image.encode("utf-8")).hexdigest()[:16]
+
+    return cache_dir / f"wsclean_{digest}.sif"
+
+
+@lru_cache(maxsize=1)
+def pull_wsclean_container(ttl: Optional[float] = None) -> Path:
+    """Download the docker image for wsclean. The container is cached on disk,
+    and an existing cached container is returned without downloading. Repeated
+    calls within a process return the same path without checking the disk. 
+
+    Should the image reference be a mutable tag, a maximum age of the cached
+    container may be set, after which it is downloaded again. 
+
+    Args:
+        ttl (Optional[float], optional): Maximum age of the cached container in seconds. If None the `GLASS_WSCLEAN_CACHE_TTL` environment variable is used, and if that is not set the cached container never expires. Defaults to None.
 
     Returns:
         Path: Path to the singularity container downloaded
     """
+    if ttl is None and "GLASS_WSCLEAN_CACHE_TTL" in os.environ:
+        ttl = float(os.environ["GLASS_WSCLEAN_CACHE_TTL"])
+
+    cache_path = get_wsclean_cache_path()
+    try:
+        cache_age = time.time() - os.stat(cache_path).st_mtime
+    except FileNotFoundError:
+        cache_age = None
+
+    if cache_age is not None and (ttl is None or cache_age < ttl):
+        logger.info(f"Using cached WSCLEAN container {cache_path}")
+        return cache_path
+
     logger.info(f"Downloading WSCLEAN docker image: {WSCLEANDOCKER}")
 
-    sclient.load(WSCLEANDOCKER)
-    sclient_path = Path(sclient.pull())
+    # Pull to a temporary name and rename, so a partial download is never 
+    # mistaken for a cached container
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_name = f"{cache_path.stem}.{os.getpid()}.tmp"
+    sclient_path = Path(
+        sclient.pull(WSCLEANDOCKER, name=f"{tmp_name}.sif", pull_folder=str(cache_path.parent))
+    )
+    sclient_path.rename(cache_path)
+
+    logger.info(f"Downloaded container to {cache_path=}")
+
+    return cache_path
 
-    logger.info(f"Downloaded container to {sclient_path=}")
 
-    return sclient_path
+def get_baseline_averaging_wavelengths(size: int, max_peak_smearing: float, scale_arcsec: float = PIXEL_SCALE_ARCSEC) -> float:
+    """Compute the `-baseline-averaging` parameter of wsclean, the number of 
+    wavelengths that visibilities may be averaged over, such that the smearing
+    at the edge of the image remains below a fraction of the peak. 
+
+    Averaging over `du` wavelengths scales the amplitude of a source at direction
+    cosine `l` by `sinc(du * l)`. Requiring this be at least `1 - max_peak_smearing`
+    at the image edge, `l = size * scale / 2`, and taking the leading terms of the
+    series `sinc(x) ~ 1 - (pi x)^2 / 6`, gives `du = sqrt(6 s) / (pi l)`. 
+
+    Args:
+        size (int): Size of the image in pixels along one axis
+        max_peak_smearing (float): Maximum tolerated fractional reduction of peak flux
+        scale_arcsec (float, optional): Size of an image pixel, in arcseconds. Defaults to PIXEL_SCALE_ARCSEC.
+
+    Returns:
+        float: The number of wavelengths to average over
+    """
+    edge_l = math.radians(scale_arcsec / 3600.) * size / 2
+
+    return math.sqrt(6 * max_peak_smearing) / (math.pi * edge_l)
+
+
+def choose_channels_out(ms_nchan: int, factor: int) -> int:
+    """Choose the number of output channels for wsclean, being the largest divisor
+    of the number of channels in the measurement set that is no more than 
+    `ms_nchan // factor`. Using a divisor ensures each output channel is formed
+    from the same number of input channels. 
+
+    Args:
+        ms_nchan (int): Number of channels in the measurement set
+        factor (int): Approximate number of input channels per output channel
+
+    Returns:
+        int: Number of output channels
+    """
+    channels_out = max(ms_nchan // factor, 1)
+    while ms_nchan % channels_out:
+        channels_out -= 1
+
+    return channels_out
 
 
 def generate_wsclean_cmd(
@@ -91,61 +227,179 @@ def generate_wsclean_cmd(
     if options.stop_negative:
         other_options = f" -stop-negative "
 
+    # Without an explicit core count wsclean chooses its own number of threads
+    cores = options.cores if options.cores is not None else get_available_cores()
+    parallel_gridding = (
+        options.parallel_gridding
+        if options.parallel_gridding is not None
+        else min(max(cores // 2, 1), MAX_PARALLEL_GRIDDING)
+    )
+    parallel_reordering = (
+        options.parallel_reordering
+        if options.parallel_reordering is not None
+        else min(cores, DEFAULT_PARALLEL_REORDERING)
+    )
+    parallel_options = (
+        (f"-j {cores} " if options.cores is not None else "")
+        + f"-parallel-reordering {parallel_reordering} "
+        f"-parallel-gridding {parallel_gridding} "
+    )
+
+    if options.channels_out_factor is not None:
+        ms_nchan = get_nchan(point)
+        channels_out = choose_channels_out(ms_nchan, options.channels_out_factor)
+        logger.info(f"Using {channels_out} output channels for the {ms_nchan} channels in {point.ms}")
+    else:
+        channels_out = options.channels_out
+
+    if options.bl_averaging:
+        nwavelengths = get_baseline_averaging_wavelengths(options.size, options.max_peak_smearing)
+        averaging = f"-baseline-averaging {nwavelengths:.2f} "
+    else:
+        averaging = ""
+
+    # Reordered visibilities are otherwise written to the working directory. Only
+    # an explicitly requested directory is used, as $TMPDIR may be too small
+    temp_dir = Path(options.temp_dir) if options.temp_dir is not None else None
+    if temp_dir is not None:
+        temp_dir_options = f"-temp-dir {temp_dir}"
+    else:
+        temp_dir_options = ""
+
+    # wsclean otherwise falls back to w-stacking
+    gridder = "-use-wgridder " if options.use_wgridder else ""
+
     logger.debug(f"{outname=}")
     logger.debug(f"{mask_options}")
 
-    cmd = f"""wsclean 
-    -abs-mem {options.absmem} 
-    -mgain {options.mgain}      
-    {mask_options} 
-    -nmiter {options.nmiter} 
-    -niter {options.niter} 
-    -auto-threshold {options.autothresh} 
-    -name {outname} 
-    -size {options.size} {options.size} 
-    -scale 0.3asec 
-    -weight briggs {options.robust} 
-    -pol I 
-    -use-wgridder 
-    -join-channels 
-    {multiscale}
-    -channels-out {options.channels_out} 
-    -fit-spectral-pol {options.fit_spectral_pol}
-    {other_options}
-    -data-column DATA 
-    {MS}"""
-
-    cmd = " ".join([i.strip() for i in cmd.splitlines()])
+    cmd = _WSCLEAN_CMD_TEMPLATE.format(
+        absmem=options.absmem,
+        mgain=options.mgain,
+        mask_options=mask_options.strip(),
+        nmiter=options.nmiter,
+        niter=options.niter,
+        autothresh=options.autothresh,
+        outname=outname,
+        size=options.size,
+        scale=PIXEL_SCALE_ARCSEC,
+        robust=options.robust,
+        gridder=gridder.strip(),
+        averaging=averaging.strip(),
+        multiscale=multiscale.strip(),
+        channels_out=channels_out,
+        fit_spectral_pol=options.fit_spectral_pol,
+        other_options=other_options.strip(),
+        parallel_options=parallel_options.strip(),
+        temp_dir_options=temp_dir_options,
+        MS=MS,
+    )
     logger.debug(f"The wsclean command is \n {cmd}")
 
-    wsclean_cmd = WSCleanCMD(cmd=cmd, outname=outname)
+    wsclean_cmd = WSCleanCMD(cmd=cmd, outname=outname, temp_dir=temp_dir)
 
     return wsclean_cmd
 
 
-def move_wsclean_out_into(dest_path: Path, outname: str) -> None:
+def find_wsclean_products(work_dir: Path, prefix: str, suffixes: Tuple[str, ...]) -> List[Path]:
+    """Find files produced by wsclean whose names start with `prefix` and end
+    with any of `suffixes`, using a single pass over the directory listing. 
+
+    Args:
+        work_dir (Path): Directory to search
+        prefix (str): Leading component of the file names
+        suffixes (Tuple[str, ...]): Trailing components of the file names
+
+    Returns:
+        List[Path]: Paths of the matching files
+    """
+    with os.scandir(work_dir) as entries:
+        return [
+            Path(entry.path) for entry in entries 
+            if entry.name.startswith(prefix) and entry.name.endswith(suffixes)
+        ]
+
+
+def move_wsclean_out_into(dest_path: Path, outname: str, work_dir: Optional[Path] = None) -> None:
     """Move a set of files produced by wsclean into a output directory. 
-    A glob expression based on the provided `outname` is used to 
-    identify files that will be moved. 
+    Files whose names start with the provided `outname` are the
+    files that will be moved. 
     
     If the `outname` is correctly formed, files include the dirty maps, 
     synthesised PSFs, clean models and restored images. 
 
     Args:
         dest_path (Path): The directory to move files into
-        outname (str): Component of the filename to glob against. 
+        outname (str): Leading component of the filenames to move. 
+        work_dir (Optional[Path], optional): Directory the files are moved from, which a relative `dest_path` is also relative to. Defaults to None, the current directory.
     """
+    work_dir = Path(os.getcwd()) if work_dir is None else work_dir
+    dest_path = work_dir / dest_path
+
     if not dest_path.exists():
         logger.info(f"Creating {dest_path}")
         dest_path.mkdir(parents=True)
 
-    files = glob(f"{outname}*")
+    dest_dir = str(dest_path)
+    src_dir = str(work_dir)
+    src_stat, dest_stat = os.stat(src_dir), os.stat(dest_dir)
+    if os.path.samestat(src_stat, dest_stat):
+        logger.debug(f"{dest_dir} is the working directory, nothing to move")
+        return
+
+    # A prefix match on the directory listing, rather than a glob pattern
+    with os.scandir(src_dir) as entries:
+        files = [entry.name for entry in entries if entry.name.startswith(outname)]
     logger.debug(f"Searched for files matching {outname}, found {len(files)}")
 
-    for file in files:
-        file_path = Path(file)
-        logger.debug(f"Moving {file} into {str(dest_path)}")
-        file_path.rename(dest_path / file_path.name)
+    if src_stat.st_dev == dest_stat.st_dev:
+        for file in files:
+            logger.debug(f"Moving {file} into {dest_dir}")
+            os.rename(os.path.join(src_dir, file), os.path.join(dest_dir, file))
+    else:
+        # Across filesystems each move is a copy and delete, which are
+        # dominated by waiting on I/O, so several are carried out at once
+        logger.debug(f"{dest_dir} is on a different filesystem, moving files concurrently")
+        with ThreadPoolExecutor(max_workers=MAX_MOVE_WORKERS) as executor:
+            list(executor.map(
+                lambda file: shutil.move(os.path.join(src_dir, file), os.path.join(dest_dir, file)), files
+            ))
+
+
+# Long-lived container instances, keyed by the image and bind path they were
+# started with, so that repeated wsclean calls skip the container start up
+_INSTANCES: Dict[Tuple[str, str], Any] = {}
+
+
+def _stop_instances() -> None:
+    """Stop any container instances started by `_ensure_instance`. 
+    """
+    while _INSTANCES:
+        _, instance = _INSTANCES.popitem()
+        logger.debug(f"Stopping container instance {instance}")
+        instance.stop()
+
+
+atexit.register(_stop_instances)
+
+
+def _ensure_instance(wsclean_img: Path, binddir: str) -> Any:
+    """Return a persistent singularity instance of the wsclean container, starting 
+    one on first use. The bind path can only be set when an instance starts, so a 
+    separate instance is kept for each bind path. 
+
+    Args:
+        wsclean_img (Path): Path to the singularity image container wsclean
+        binddir (str): Directories to include in the singularity bindpath
+
+    Returns:
+        Any: The running `spython` instance
+    """
+    key = (str(wsclean_img), binddir)
+    if key not in _INSTANCES:
+        logger.info(f"Starting a persistent instance of {wsclean_img}")
+        _INSTANCES[key] = sclient.instance(str(wsclean_img), options=["--bind", binddir])
+
+    return _INSTANCES[key]
 
 
 def run_wsclean_cmd(
@@ -154,31 +408,54 @@ def run_wsclean_cmd(
     binddir: Optional[Path] = None,
     move_into: Optional[Path] = None,
     clean_up: bool = True,
+    background_clean_up: bool = False,
+    persistent: bool = False,
 ) -> None:
     """Execute a `WSCleanCMD` string within the context of a wsclean singularity container. 
     Output produced by `wsclean` will be streamed to the stderr. 
 
+    With `persistent` the command is executed in a persistent instance of the container,
+    which is started on the first call and stopped when the interpreter exits. An
+    instance outlives a process that is killed outright (e.g. SIGKILL or an
+    out-of-memory kill), so it is only worth it for callers running many commands. 
+
     Args:
         wsclean_img (Path): Path to the singularity image container wsclean
         wsclean_cmd (WSCleanCMD): The processed wsclean command that will be executed
         binddir (Optional[Path], optional): Additional directories to include in the singularity bindpath. Defaults to None.
         move_into (Optional[Path], optional): Directory location to move files into. Defaults to None.
         clean_up (bool, optional): Will delete 'unnecessary' files, including the dirty maps and PSFs. This is primarily intended to conserve disk space. Defaults to True.
+        background_clean_up (bool, optional): Delete the 'unnecessary' files in a background thread rather than waiting for their removal. Defaults to False.
+        persistent (bool, optional): Execute within a persistent container instance rather than starting the container for this call alone. Defaults to False.
     """
-    binddir = Path(os.getcwd()) if binddir is None else binddir
+    # Taken once, so the same directory is bound and cleaned should the
+    # caller change directory while wsclean runs
+    work_dir = Path(os.getcwd())
+    binddir = work_dir if binddir is None else binddir
     binddir_str = str(binddir)
+    if wsclean_cmd.temp_dir is not None:
+        binddir_str = f"{binddir_str},{wsclean_cmd.temp_dir}"
 
     logger.debug(f"Container {wsclean_img=}")
     logger.debug(f"Will bind to: {binddir_str}")
     logger.debug(f"Command to execute: {wsclean_cmd.cmd}")
 
-    result = sclient.execute(
-        image=wsclean_img,
-        command=wsclean_cmd.cmd,
-        bind=binddir_str,
-        return_result=True,
-        stream=True,
-    )
+    if persistent:
+        # The bind path is fixed when the instance is started
+        result = sclient.execute(
+            image=_ensure_instance(wsclean_img, binddir_str),
+            command=wsclean_cmd.cmd,
+            return_result=True,
+            stream=True,
+        )
+    else:
+        result = sclient.execute(
+            image=wsclean_img,
+            command=wsclean_cmd.cmd,
+            bind=binddir_str,
+            return_result=True,
+            stream=True,
+        )
 
     # Streaming the output from the singularity command
     for line in result:
@@ -186,18 +463,87 @@ def run_wsclean_cmd(
 
     # Cleanup to save space
     if clean_up:
-        work_dir = Path(os.getcwd())
-        remove_files_folders(
-            list(work_dir.glob(f"{wsclean_cmd.outname}*dirty.fits"))
-            + list(work_dir.glob(f"{wsclean_cmd.outname}*psf.fits"))
-            # + list(work_dir.glob(f"{wsclean_cmd.outname}*residual.fits"))
+        if background_clean_up and move_into is not None:
+            # Move first, so that the background removal does not race
+            # against the files being moved
+            move_wsclean_out_into(move_into, wsclean_cmd.outname, work_dir=work_dir)
+            work_dir = work_dir / move_into
+            move_into = None
+
+        remove = remove_files_folders_background if background_clean_up else remove_files_folders
+        # Residual images are kept
+        remove(
+            find_wsclean_products(work_dir, wsclean_cmd.outname, ("dirty.fits", "psf.fits"))
         )
 
     if move_into is not None:
-        move_wsclean_out_into(move_into, wsclean_cmd.outname)
+        move_wsclean_out_into(move_into, wsclean_cmd.outname, work_dir=work_dir)
+
 
+def synthesize_wsclean_header(point: Pointing, options: WSCleanOptions) -> fits.header.Header:
+    """Construct the FITS header that `wsclean` would write for an image of a 
+    measurement set, without running `wsclean`. The celestial axes follow the 
+    `wsclean` convention of a SIN projection about the phase centre, with the 
+    reference pixel at `size // 2 + 1`. The spectral axis describes the full 
+    band of the measurement set, as in a multi-frequency synthesis image. 
+
+    Args:
+        point (Pointing): Measurement set the header describes
+        options (WSCleanOptions): Imaging specification to use. This should be the same as the intended final image. 
 
-def generate_wsclean_header(wsclean_img: Path, point: Pointing,options: WSCleanOptions,binddir: Optional[Path] = None) -> fits.header.Header:
+    Returns:
+        fits.header.Header: The FITS header to be expected from `wsclean` produced images. 
+    """
+    from pyrap import tables
+
+    with tables.table(str(point.ms / "FIELD"), ack=False) as field_tab:
+        ra_rad, dec_rad = field_tab.getcell("PHASE_DIR", 0)[0]
+
+    with tables.table(str(point.ms / "SPECTRAL_WINDOW"), ack=False) as spw_tab:
+        chan_freqs = spw_tab.getcol("CHAN_FREQ")
+        chan_widths = spw_tab.getcol("CHAN_WIDTH")
+
+    freq_low = float((chan_freqs - abs(chan_widths) / 2).min())
+    freq_high = float((chan_freqs + abs(chan_widths) / 2).max())
+
+    scale_deg = PIXEL_SCALE_ARCSEC / 3600.
+    crpix = options.size // 2 + 1
+
+    header = fits.Header()
+    header["NAXIS"] = 4
+    header["NAXIS1"] = options.size
+    header["NAXIS2"] = options.size
+    header["NAXIS3"] = 1
+    header["NAXIS4"] = 1
+    header["CTYPE1"] = "RA---SIN"
+    header["CRPIX1"] = crpix
+    header["CRVAL1"] = math.degrees(ra_rad) % 360.
+    header["CDELT1"] = -scale_deg
+    header["CUNIT1"] = "deg"
+    header["CTYPE2"] = "DEC--SIN"
+    header["CRPIX2"] = crpix
+    header["CRVAL2"] = math.degrees(dec_rad)
+    header["CDELT2"] = scale_deg
+    header["CUNIT2"] = "deg"
+    header["CTYPE3"] = "FREQ"
+    header["CRPIX3"] = 1
+    header["CRVAL3"] = (freq_low + freq_high) / 2
+    header["CDELT3"] = freq_high - freq_low
+    header["CUNIT3"] = "Hz"
+    header["CTYPE4"] = "STOKES"
+    header["CRPIX4"] = 1
+    header["CRVAL4"] = 1
+    header["CDELT4"] = 1
+    header["CUNIT4"] = ""
+    header["RADESYS"] = "FK5"
+    header["EQUINOX"] = 2000.
+
+    logger.debug(f"Synthesized header for {point.ms}")
+
+    return header
+
+
+def generate_wsclean_header(wsclean_img: Path, point: Pointing,options: WSCleanOptions,binddir: Optional[Path] = None, workdir: Optional[Path] = None) -> fits.header.Header:
     """Will return a generice FITS header that would be expected from a genuine `wsclean` image. Internally
     a `wsclean` command is executed to generate a image with no cleaning. The header is extracted and returned
     after the image products are delected. 
@@ -207,6 +553,7 @@ def generate_wsclean_header(wsclean_img: Path, point: Pointing,options: WSCleanO
         point (Pointing): Measurement set to image to extract the header from
         options (WSCleanOptions): Imaging specification to use. This should be the same as the intended final image. 
         binddir (Path, optional): Additional directories to bind to. Defaults ot None. 
+        workdir (Path, optional): Directory that wsclean is executed in and its images are written to. Defaults to the current working directory. 
         
     Returns:
         fits.header.Header: The extracted FITS header to be expected from `wsclean` produced images. 
@@ -215,11 +562,18 @@ def generate_wsclean_header(wsclean_img: Path, point: Pointing,options: WSCleanO
     MS = point.ms
     logger.info(f"Generating a dirty map for wsclean {point.ms}. ")
 
-    binddir = Path(os.getcwd()) if binddir is None else binddir
+    work_dir = Path(os.getcwd()) if workdir is None else workdir
+    binddir = work_dir if binddir is None else binddir
     binddir_str = str(binddir)
 
     outname = f"{point.field}_" f"round{options.round}_" "mask"
 
+    # The header should describe the same spectral setup as the intended image
+    if options.channels_out_factor is not None:
+        channels_out = choose_channels_out(get_nchan(point), options.channels_out_factor)
+    else:
+        channels_out = options.channels_out
+
     cmd = f"""wsclean 
     -abs-mem {options.absmem} 
     -mgain 1.0
@@ -227,16 +581,16 @@ def generate_wsclean_header(wsclean_img: Path, point: Pointing,options: WSCleanO
     -niter 0 
     -name {outname} 
     -size {options.size} {options.size} 
-    -scale 0.3asec 
+    -scale {PIXEL_SCALE_ARCSEC}asec 
     -weight briggs {options.robust} 
     -pol XX 
     -use-wgridder 
     -join-channels 
-    -channels-out {options.channels_out} 
+    -channels-out {channels_out} 
     -data-column DATA 
     {MS}"""
 
-    cmd = " ".join([i.strip() for i in cmd.splitlines()])
+    cmd = _WHITESPACE_RE.sub(" ", cmd).strip()
     logger.debug(f"The wsclean command is \n {cmd}")
 
     logger.info(f"Constructed out name if {outname}")
@@ -246,6 +600,7 @@ def generate_wsclean_header(wsclean_img: Path, point: Pointing,options: WSCleanO
         image=wsclean_img,
         command=cmd,
         bind=binddir_str,
+        options=["--pwd", str(work_dir)],
         return_result=True,
         stream=True,
     )
@@ -254,13 +609,11 @@ def generate_wsclean_header(wsclean_img: Path, point: Pointing,options: WSCleanO
     for line in result:
         logger.info(line.rstrip())
 
-    work_dir = Path(os.getcwd())
-
-    image_header = fits.getheader(f"{outname}-MFS-image.fits")
+    # Only the primary header blocks are read, without building an HDU list
+    image_header = fits.Header.fromfile(str(work_dir / f"{outname}-MFS-image.fits"))
 
     remove_files_folders(
-        list(work_dir.glob(f"{outname}-00??*fits"))
-        + list(work_dir.glob(f"{outname}-MFS-*.fits"))
+        find_wsclean_products(work_dir, f"{outname}-", ("fits",))
     )
 
     logger.debug(f"Imager header is {type(image_header)}")
@@ -0,0 +1,43 @@
+import pytest
+
+# The module imports casatasks and casatools at load time
+pytest.importorskip("casatasks")
+
+from glass_image.casa_selfcal import ChannelBlock, split_channel_blocks
+
+
+def test_blocks_cover_every_channel_once():
+    blocks = split_channel_blocks([288], 4)
+
+    assert [block.selection for block in blocks] == ["0:0~71", "0:72~143", "0:144~215", "0:216~287"]
+
+
+def test_uneven_blocks():
+    blocks = split_channel_blocks([10], 3)
+
+    channels = [chan for block in blocks for chan in range(block.start, block.end + 1)]
+    assert channels == list(range(10))
+    assert len(blocks) == 3
+
+
+def test_more_blocks_than_channels():
+    blocks = split_channel_blocks([2], 4)
+
+    assert blocks == [ChannelBlock(0, 0, 0), ChannelBlock(0, 1, 1)]
+
+
+def test_whole_spectral_windows():
+    blocks = split_channel_blocks([8, 8, 8, 8], 4)
+
+    assert blocks == [ChannelBlock(spw, 0, 7) for spw in range(4)]
+
+
+def test_blocks_do_not_span_spectral_windows():
+    blocks = split_channel_blocks([8, 6], 4)
+
+    assert blocks == [
+        ChannelBlock(0, 0, 3),
+        ChannelBlock(0, 4, 7),
+        ChannelBlock(1, 0, 2),
+        ChannelBlock(1, 3, 5),
+    ]
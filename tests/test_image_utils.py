@@ -0,0 +1,63 @@
+import numpy as np
+from astropy.wcs import WCS
+
+from glass_image.image_utils import _aligned_pixel_offset, _as_mask
+
+
+def _celestial_wcs(crpix=(101.0, 101.0), crval=(150.0, -30.0), cdelt=0.3 / 3600):
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ["RA---SIN", "DEC--SIN"]
+    wcs.wcs.crpix = list(crpix)
+    wcs.wcs.crval = list(crval)
+    wcs.wcs.cdelt = [-cdelt, cdelt]
+
+    return wcs
+
+
+def test_as_mask_float():
+    data = np.array([[0.0, 1.5, -2.0], [np.nan, np.inf, 0.0]], dtype=np.float32)
+
+    mask = _as_mask(data)
+
+    assert mask.dtype == np.uint8
+    assert mask.tolist() == [[0, 1, 1], [0, 1, 0]]
+
+
+def test_as_mask_integer():
+    data = np.array([[0, 3], [-1, 0]], dtype=np.int16)
+
+    assert _as_mask(data).tolist() == [[0, 1], [1, 0]]
+
+
+def test_as_mask_uint8_is_clamped():
+    data = np.array([[0, 1, 255]], dtype=np.uint8)
+
+    mask = _as_mask(data)
+
+    assert mask.dtype == np.uint8
+    assert mask.tolist() == [[0, 1, 1]]
+
+
+def test_aligned_offset_whole_pixels():
+    mosaic = _celestial_wcs(crpix=(501.0, 401.0))
+    target = _celestial_wcs(crpix=(101.0, 101.0))
+
+    assert _aligned_pixel_offset(mosaic, target) == (400, 300)
+
+
+def test_aligned_offset_fractional_pixels():
+    mosaic = _celestial_wcs(crpix=(501.5, 401.0))
+    target = _celestial_wcs(crpix=(101.0, 101.0))
+
+    assert _aligned_pixel_offset(mosaic, target) is None
+
+
+def test_aligned_offset_different_grids():
+    target = _celestial_wcs()
+
+    assert _aligned_pixel_offset(_celestial_wcs(crval=(150.1, -30.0)), target) is None
+    assert _aligned_pixel_offset(_celestial_wcs(cdelt=0.5 / 3600), target) is None
+
+    mosaic = _celestial_wcs()
+    mosaic.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+    assert _aligned_pixel_offset(mosaic, target) is None
@@ -0,0 +1,81 @@
+import math
+from pathlib import Path
+
+from glass_image.wsclean import (
+    choose_channels_out,
+    find_wsclean_products,
+    get_baseline_averaging_wavelengths,
+    move_wsclean_out_into,
+)
+
+
+def test_baseline_averaging_grows_with_smearing():
+    lengths = [
+        get_baseline_averaging_wavelengths(size=7000, max_peak_smearing=s)
+        for s in (0.01, 0.05, 0.1, 0.25)
+    ]
+
+    assert lengths == sorted(lengths)
+    assert len(set(lengths)) == len(lengths)
+
+
+def test_baseline_averaging_bounds_edge_smearing():
+    size, scale_arcsec = 7000, 0.3
+    edge_l = math.radians(scale_arcsec / 3600.) * size / 2
+
+    for smearing in (0.01, 0.1, 0.25):
+        du = get_baseline_averaging_wavelengths(
+            size=size, max_peak_smearing=smearing, scale_arcsec=scale_arcsec
+        )
+        x = math.pi * du * edge_l
+        amplitude = math.sin(x) / x
+
+        # The bound holds, without being overly conservative
+        assert 1 - smearing <= amplitude < 1 - 0.9 * smearing
+
+
+def test_channels_out_divides_channels():
+    assert choose_channels_out(2048, 64) == 32
+    # 288 // 64 = 4, which divides 288
+    assert choose_channels_out(288, 64) == 4
+    # 100 // 8 = 12, the largest divisor of 100 no more than that is 10
+    assert choose_channels_out(100, 8) == 10
+
+
+def test_channels_out_edge_cases():
+    # Fewer channels than the factor, or a prime number of channels
+    assert choose_channels_out(10, 64) == 1
+    assert choose_channels_out(97, 8) == 1
+    assert choose_channels_out(1, 1) == 1
+
+
+def test_find_wsclean_products(tmp_path):
+    names = [
+        "F_round1-MFS-image.fits",
+        "F_round1-0000-dirty.fits",
+        "F_round1-0000-psf.fits",
+        "F_round10-0000-psf.fits",
+        "G_round1-0000-psf.fits",
+        "F_round1-0000-psf.fits.bak",
+    ]
+    for name in names:
+        (tmp_path / name).touch()
+
+    found = find_wsclean_products(tmp_path, "F_round1-", ("dirty.fits", "psf.fits"))
+
+    assert sorted(path.name for path in found) == ["F_round1-0000-dirty.fits", "F_round1-0000-psf.fits"]
+    assert all(path.parent == tmp_path for path in found)
+
+
+def test_move_wsclean_out_into(tmp_path):
+    for name in ("F_round1-MFS-image.fits", "G_round1-MFS-image.fits"):
+        (tmp_path / name).touch()
+
+    move_wsclean_out_into(Path("round_1"), "F_round1", work_dir=tmp_path)
+
+    assert (tmp_path / "round_1" / "F_round1-MFS-image.fits").exists()
+    assert (tmp_path / "G_round1-MFS-image.fits").exists()
+
+    # Moving into the working directory itself is a no-op
+    move_wsclean_out_into(tmp_path, "G_round1", work_dir=tmp_path)
+    assert (tmp_path / "G_round1-MFS-image.fits").exists()